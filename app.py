@@ -1,77 +1,419 @@
-
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session, send_file
 import sqlite3
+import fcntl
+import functools
 import hashlib
+import json
+import re
+import threading
+import time
+import uuid
 from datetime import datetime
 import os
 
+from dblocks import RetryPolicy, begin_write, is_lock_error, lock_stats, summary as lock_summary
+from notify_bus import InProcessBus, create_bus
+from profiler import ProfiledConnection, QueryProfiler
+from rollups import catch_up_rollups, init_rollup_schema, read_stats
+from sharding import ShardRouter, next_message_id
+from storage import ContentStore
+from thumbnails import ThumbnailPipeline
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-12345')
 app.config['DATABASE'] = 'messenger.db'
+app.config['ATTACHMENTS_DIR'] = os.environ.get('ATTACHMENTS_DIR', 'attachments')
+app.config['MAX_ATTACHMENT_SIZE'] = int(os.environ.get('MAX_ATTACHMENT_SIZE', 50 * 1024 * 1024))
+app.config['MAX_CHUNK_SIZE'] = 4 * 1024 * 1024
+# Незавершенные загрузки без активности дольше этого срока удаляются (0 - не удалять)
+app.config['UPLOAD_TTL_HOURS'] = float(os.environ.get('UPLOAD_TTL_HOURS', 24))
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+
+app.config['ADMIN_USERS'] = [u for u in os.environ.get('ADMIN_USERS', '').split(',') if u]
+# Профилирование SQL включается заданием порога в миллисекундах
+app.config['SLOW_QUERY_MS'] = os.environ.get('SLOW_QUERY_MS')
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+# Ожидание блокировки SQLite (с) и повторы с паузой при занятой БД
+app.config['DB_BUSY_TIMEOUT'] = float(os.environ.get('DB_BUSY_TIMEOUT', 5))
+app.config['DB_RETRY_ATTEMPTS'] = int(os.environ.get('DB_RETRY_ATTEMPTS', 5))
+app.config['DB_RETRY_BASE_MS'] = float(os.environ.get('DB_RETRY_BASE_MS', 20))
+app.config['DB_RETRY_MAX_MS'] = float(os.environ.get('DB_RETRY_MAX_MS', 1000))
+# Шина уведомлений о новых сообщениях: memory://, unix:///path.sock, redis://host:port
+app.config['NOTIFY_BUS'] = os.environ.get('NOTIFY_BUS', 'memory://')
+app.config['MAX_WAIT_TIMEOUT'] = 30
+app.config['MAX_BATCH_SIZE'] = 100
+# Больше сообщений за один запрос истории не отдается; остальное - следующими страницами
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 500))
+# Сколько дней хранить ревизии и надгробия удаленных сообщений и как часто чистить
+app.config['MESSAGE_RETENTION_DAYS'] = int(os.environ.get('MESSAGE_RETENTION_DAYS', 30))
+app.config['VACUUM_INTERVAL_HOURS'] = float(os.environ.get('VACUUM_INTERVAL_HOURS', 24))
+# Как часто новые сообщения учитываются в сводной статистике (0 - не учитывать)
+app.config['ROLLUP_INTERVAL_SECONDS'] = float(os.environ.get('ROLLUP_INTERVAL_SECONDS', 60))
+# Шардирование сообщений: 0 - все в основной БД, N - переписки по N файлам
+app.config['SHARD_COUNT'] = int(os.environ.get('SHARD_COUNT', 0))
+app.config['SHARD_PATH'] = os.environ.get('SHARD_PATH', 'messenger-shard-{}.db')
+# Файл блокировки, которой выбирается единственный процесс с фоновыми задачами
+# (по умолчанию рядом с основной БД: <DATABASE>.jobs.lock)
+app.config['JOBS_LOCK'] = os.environ.get('JOBS_LOCK')
+# Целевое время запуска воркера; при превышении create_app() выводит предупреждение
+app.config['STARTUP_TARGET_MS'] = float(os.environ.get('STARTUP_TARGET_MS', 500))
+
+# Ресурсы создаются в create_app(); импорт модуля не трогает диск
+store = ContentStore(app.config['ATTACHMENTS_DIR'])
+thumbnails = ThumbnailPipeline(store, workers=app.config['THUMBNAIL_WORKERS'])
+profiler = None
+bus = InProcessBus()
+router = None
+background_jobs = {}
+jobs_leader = None
+jobs_lock = None
+retry_policy = RetryPolicy()
 
-def get_db():
+def get_db(path=None):
     """Подключение к базе данных"""
-    conn = sqlite3.connect(app.config['DATABASE'])
+    path = path or app.config['DATABASE']
+    timeout = app.config['DB_BUSY_TIMEOUT']
+    if profiler is not None:
+        conn = sqlite3.connect(path, timeout=timeout, factory=ProfiledConnection)
+        conn.profiler = profiler
+    else:
+        conn = sqlite3.connect(path, timeout=timeout)
     conn.row_factory = sqlite3.Row
     return conn
 
+def retry_locked(func):
+    """Повторять func(db, ...) при занятой БД по политике retry_policy"""
+    @functools.wraps(func)
+    def wrapper(db, *args):
+        return retry_policy.run(func, db, *args)
+    return wrapper
+
+def db_error_response(e):
+    """Ответ на ошибку SQLite; занятая после всех повторов БД - 503 с Retry-After"""
+    if is_lock_error(e):
+        response = jsonify({'success': False, 'error': 'База данных занята, попробуйте позже'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+
+def get_messages_db(user_id, other_user_id, write=False):
+    """Подключение к БД с перепиской пары или к основной БД, если шардирование выключено"""
+    if router is None:
+        return get_db()
+    conn = get_db(router.path(router.shard_for(user_id, other_user_id)))
+    # Справочник (users, attachments) подключается только для чтения, см. sharding.py
+    if not write:
+        conn.execute("ATTACH DATABASE ? AS directory", (app.config['DATABASE'],))
+    return conn
+
+def message_stores(db):
+    """Все хранилища сообщений: переданное соединение или каждый шард по очереди"""
+    if router is None:
+        yield db
+        return
+    for path in router.paths():
+        conn = get_db(path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+def json_object():
+    """Тело запроса, если это JSON-объект, иначе None"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+def is_admin():
+    """Текущий пользователь - администратор (список ADMIN_USERS)"""
+    return session.get('username') in app.config['ADMIN_USERS']
+
+# Версия схемы хранится в PRAGMA user_version; при изменении схемы увеличивается
+SCHEMA_VERSION = 7
+
+# Сколько строк переписки читается из курсора и сериализуется за раз
+STREAM_CHUNK_ROWS = 200
+
+def create_app(config=None):
+    """Фабрика приложения: конфигурация, ресурсы и однократные миграции (фоновые задачи - start_background_jobs)"""
+    global store, thumbnails, profiler, bus, router, retry_policy
+    started = time.perf_counter()
+    
+    if config:
+        app.config.update(config)
+    
+    store = ContentStore(app.config['ATTACHMENTS_DIR'])
+    thumbnails = ThumbnailPipeline(store, workers=app.config['THUMBNAIL_WORKERS'])
+    if app.config['SLOW_QUERY_MS'] is not None and profiler is None:
+        profiler = QueryProfiler(float(app.config['SLOW_QUERY_MS']), log_path=app.config['SLOW_QUERY_LOG'])
+    bus.close()
+    bus = create_bus(app.config['NOTIFY_BUS'])
+    retry_policy = RetryPolicy(
+        app.config['DB_RETRY_ATTEMPTS'], app.config['DB_RETRY_BASE_MS'], app.config['DB_RETRY_MAX_MS']
+    )
+    
+    init_db()
+    
+    router = None
+    if app.config['SHARD_COUNT']:
+        router = ShardRouter(app.config['SHARD_COUNT'], app.config['SHARD_PATH'])
+        init_shards()
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms > app.config['STARTUP_TARGET_MS']:
+        print(f"⚠️ Запуск занял {elapsed_ms:.0f} мс (цель {app.config['STARTUP_TARGET_MS']:.0f} мс)")
+    else:
+        print(f"✅ Приложение готово за {elapsed_ms:.0f} мс")
+    return app
+
+def migrate(db, version, apply):
+    """Обновить схему до version функцией apply(cursor), если она устарела"""
+    if db.execute("PRAGMA user_version").fetchone()[0] >= version:
+        return False
+    
+    db.isolation_level = None
+    cursor = db.cursor()
+    # Параллельно стартующие процессы ждут блокировку и, увидев актуальную
+    # user_version, ничего не делают
+    cursor.execute("BEGIN EXCLUSIVE")
+    try:
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+            cursor.execute("COMMIT")
+            return False
+        apply(cursor)
+        cursor.execute(f"PRAGMA user_version = {version}")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    return True
+
+def init_messages_schema(cursor):
+    """Таблица сообщений с индексами (общая для основной БД и шардов)"""
+    # Таблица сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            is_read INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Ссылка сообщения на вложение (для старых баз добавляем колонку)
+    columns = [row['name'] for row in cursor.execute("PRAGMA table_info(messages)")]
+    if 'attachment_id' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN attachment_id INTEGER REFERENCES attachments (id)")
+    
+    # Ключ идемпотентности от клиента: повторная отправка не создает дубль
+    if 'client_id' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN client_id TEXT")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id
+        ON messages (sender_id, client_id) WHERE client_id IS NOT NULL
+    ''')
+    
+    # Правки и удаления: каждое изменение получает номер seq из счетчика
+    # переписки, удаленное сообщение остается надгробием (deleted = 1)
+    for column, ddl in (
+        ('seq', "ALTER TABLE messages ADD COLUMN seq INTEGER"),
+        ('revision', "ALTER TABLE messages ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"),
+        ('edited_at', "ALTER TABLE messages ADD COLUMN edited_at DATETIME"),
+        ('deleted', "ALTER TABLE messages ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0"),
+    ):
+        if column not in columns:
+            cursor.execute(ddl)
+    
+    # Счетчик изменений переписки; min_seq - граница, до которой надгробия
+    # уже вычищены: клиенту с более старым seq нужна полная перезагрузка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_seq (
+            low_id INTEGER NOT NULL,
+            high_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            min_seq INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (low_id, high_id)
+        )
+    ''')
+    
+    # Предыдущие версии отредактированных сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_revisions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_revisions_message ON message_revisions (message_id)"
+    )
+    
+    # Сообщениям, созданным до появления seq, нумеруем изменения по порядку id
+    cursor.execute('''
+        CREATE TEMP TABLE seq_backfill AS
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY MIN(sender_id, receiver_id), MAX(sender_id, receiver_id) ORDER BY id
+        ) AS seq
+        FROM messages WHERE seq IS NULL
+    ''')
+    cursor.execute('''
+        UPDATE messages SET seq = (SELECT b.seq FROM seq_backfill b WHERE b.id = messages.id)
+        WHERE seq IS NULL
+    ''')
+    cursor.execute("DROP TABLE seq_backfill")
+    cursor.execute('''
+        INSERT OR IGNORE INTO conversation_seq (low_id, high_id, seq)
+        SELECT MIN(sender_id, receiver_id), MAX(sender_id, receiver_id), MAX(seq)
+        FROM messages GROUP BY 1, 2
+    ''')
+    
+    # Индекс для догрузки изменений переписки по seq
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair_seq ON messages (sender_id, receiver_id, seq)"
+    )
+    
+    # Индекс для выборки переписки и догрузки новых сообщений по id
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (sender_id, receiver_id, id)"
+    )
+    # Индекс для проверки входящих при ожидании уведомлений
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, id)"
+    )
+
+def init_schema(cursor):
+    """Схема основной БД: пользователи, вложения, сообщения и тестовые данные"""
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица вложений (файл на диске адресуется по sha256)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Незавершенные (докачиваемые) загрузки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            owner_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Журнал изменений справочника пользователей: version растет монотонно,
+    # клиенты забирают только изменения после известной им версии
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            op TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_log_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO user_changes (user_id, op) VALUES (NEW.id, 'upsert');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_log_update AFTER UPDATE OF username, phone ON users
+        BEGIN
+            INSERT INTO user_changes (user_id, op) VALUES (NEW.id, 'upsert');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_log_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO user_changes (user_id, op) VALUES (OLD.id, 'delete');
+        END
+    ''')
+    # Пользователи, созданные до появления журнала
+    cursor.execute('''
+        INSERT INTO user_changes (user_id, op)
+        SELECT id, 'upsert' FROM users WHERE NOT EXISTS (SELECT 1 FROM user_changes)
+    ''')
+    
+    init_messages_schema(cursor)
+    init_rollup_schema(cursor)
+    
+    # Создаем тестовых пользователей если их нет
+    cursor.execute("SELECT COUNT(*) FROM users")
+    if cursor.fetchone()[0] == 0:
+        test_users = [
+            ('alex', '+79161234567', hash_password('password123')),
+            ('maria', '+79269876543', hash_password('password123')),
+            ('ivan', '+79031112233', hash_password('password123'))
+        ]
+        
+        for username, phone, pwd_hash in test_users:
+            try:
+                cursor.execute(
+                    "INSERT INTO users (username, phone, password_hash) VALUES (?, ?, ?)",
+                    (username, phone, pwd_hash)
+                )
+                print(f"Создан тестовый пользователь: {username}")
+            except sqlite3.IntegrityError:
+                print(f"Пользователь {username} уже существует")
+                pass
+
+def enable_wal(db):
+    """Перевести файл БД в WAL; курсор PRAGMA сразу дочитывается и закрывается,
+    чтобы его оператор не держал таблицы открытыми до конца миграции"""
+    cursor = db.execute("PRAGMA journal_mode=WAL")
+    cursor.fetchone()
+    cursor.close()
+
 def init_db():
-    """Инициализация базы данных"""
+    """Инициализация базы данных (WAL: чтение не блокирует запись)"""
     try:
         db = get_db()
-        cursor = db.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                phone TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица сообщений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER NOT NULL,
-                receiver_id INTEGER NOT NULL,
-                message_text TEXT NOT NULL,
-                is_read INTEGER DEFAULT 0,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Создаем тестовых пользователей если их нет
-        cursor.execute("SELECT COUNT(*) FROM users")
-        if cursor.fetchone()[0] == 0:
-            test_users = [
-                ('alex', '+79161234567', hash_password('password123')),
-                ('maria', '+79269876543', hash_password('password123')),
-                ('ivan', '+79031112233', hash_password('password123'))
-            ]
-            
-            for username, phone, pwd_hash in test_users:
-                try:
-                    cursor.execute(
-                        "INSERT INTO users (username, phone, password_hash) VALUES (?, ?, ?)",
-                        (username, phone, pwd_hash)
-                    )
-                    print(f"Создан тестовый пользователь: {username}")
-                except sqlite3.IntegrityError:
-                    print(f"Пользователь {username} уже существует")
-                    pass
-        
-        db.commit()
-        db.close()
-        print("✅ База данных успешно инициализирована")
+        try:
+            enable_wal(db)
+            if migrate(db, SCHEMA_VERSION, init_schema):
+                print("✅ База данных успешно инициализирована")
+        finally:
+            db.close()
         
     except Exception as e:
+        # Без схемы приложение работать не может: create_app() не должен сообщать об успехе
         print(f"❌ Ошибка инициализации БД: {e}")
+        raise
+
+def init_shards():
+    """Создание и миграция файлов шардов (WAL: чтение не блокирует запись)"""
+    for path in router.paths():
+        db = get_db(path)
+        try:
+            enable_wal(db)
+            migrate(db, SCHEMA_VERSION, init_messages_schema)
+        finally:
+            db.close()
 
 def hash_password(password):
     """Хеширование пароля"""
@@ -80,37 +422,708 @@ def hash_password(password):
 @app.route('/')
 def index():
     """Главная страница - SPA"""
-    return render_template('index.html')
+    return Response(spa_html, mimetype='text/html')
+
+# Бизнес-логика API (общая для Flask и ASGI-варианта, см. asgi.py)
+# Каждая функция принимает открытое соединение и возвращает (ответ, HTTP-статус)
+
+def do_login(db, data):
+    """Вход: возвращает (ответ, статус, пользователь или None)"""
+    username = data.get('username')
+    password = data.get('password')
+    
+    if not username or not password:
+        return {'success': False, 'error': 'Заполните все поля'}, 200, None
+    
+    cursor = db.cursor()
+    cursor.execute(
+        "SELECT id, username, password_hash FROM users WHERE username = ?", 
+        (username,)
+    )
+    user = cursor.fetchone()
+    
+    if user and user['password_hash'] == hash_password(password):
+        return {'success': True, 'username': user['username']}, 200, user
+    return {'success': False, 'error': 'Неверный логин или пароль'}, 200, None
+
+@retry_locked
+def do_register(db, data):
+    """Регистрация нового пользователя"""
+    username = data.get('username')
+    phone = data.get('phone')
+    password = data.get('password')
+    confirm = data.get('confirm')
+    
+    if not all([username, phone, password, confirm]):
+        return {'success': False, 'error': 'Заполните все поля'}, 200
+    
+    if password != confirm:
+        return {'success': False, 'error': 'Пароли не совпадают'}, 200
+    
+    if len(password) < 4:
+        return {'success': False, 'error': 'Пароль слишком короткий (мин. 4 символа)'}, 200
+    
+    cursor = db.cursor()
+    try:
+        begin_write(cursor)
+        cursor.execute(
+            "INSERT INTO users (username, phone, password_hash) VALUES (?, ?, ?)",
+            (username, phone, hash_password(password))
+        )
+        db.commit()
+        return {'success': True, 'message': 'Регистрация успешна! Теперь войдите.'}, 200
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return {'success': False, 'error': 'Логин или телефон уже заняты'}, 200
+
+def do_list_users(db, user_id):
+    """Список пользователей, кроме текущего"""
+    cursor = db.cursor()
+    cursor.execute(
+        "SELECT id, username, phone FROM users WHERE id != ? ORDER BY username",
+        (user_id,)
+    )
+    users_data = [dict(user) for user in cursor.fetchall()]
+    return {'success': True, 'users': users_data}, 200
+
+def do_sync_users(db, user_id, since):
+    """Изменения справочника после версии since; без since - полный список"""
+    try:
+        since = int(since or 0)
+    except ValueError:
+        return {'success': False, 'error': 'Некорректный since'}, 400
+    
+    cursor = db.cursor()
+    cursor.execute("SELECT MAX(version) FROM user_changes")
+    version = cursor.fetchone()[0] or 0
+    
+    if since <= 0 or since > version:
+        # Первая синхронизация (или версия из другой БД) - отдаем снимок целиком
+        payload, status = do_list_users(db, user_id)
+        return {'success': True, 'version': version, 'full': True,
+                'upserts': payload['users'], 'deletes': []}, status
+    
+    cursor.execute('''
+        SELECT c.user_id, u.username, u.phone
+        FROM (SELECT DISTINCT user_id FROM user_changes WHERE version > ? AND version <= ?) c
+        LEFT JOIN users u ON u.id = c.user_id
+        WHERE c.user_id != ?
+    ''', (since, version, user_id))
+    
+    upserts, deletes = [], []
+    for row in cursor.fetchall():
+        if row['username'] is None:
+            deletes.append(row['user_id'])
+        else:
+            upserts.append({'id': row['user_id'], 'username': row['username'], 'phone': row['phone']})
+    
+    return {'success': True, 'version': version, 'full': False,
+            'upserts': upserts, 'deletes': deletes}, 200
+
+def conversation_pair(user_id, other_user_id):
+    """Участники переписки в порядке (меньший id, больший id)"""
+    return tuple(sorted((int(user_id), int(other_user_id))))
+
+def next_conversation_seq(cursor, user_id, other_user_id):
+    """Следующий номер изменения переписки; вызывать в транзакции записи"""
+    low_id, high_id = conversation_pair(user_id, other_user_id)
+    cursor.execute('''
+        INSERT INTO conversation_seq (low_id, high_id, seq) VALUES (?, ?, 1)
+        ON CONFLICT (low_id, high_id) DO UPDATE SET seq = seq + 1
+    ''', (low_id, high_id))
+    cursor.execute(
+        "SELECT seq FROM conversation_seq WHERE low_id = ? AND high_id = ?",
+        (low_id, high_id)
+    )
+    return cursor.fetchone()['seq']
+
+class MessagePage:
+    """Страница переписки, которая читается из курсора пачками по STREAM_CHUNK_ROWS строк"""
+    
+    def __init__(self, cursor, user_id, column, seq, reset, limit):
+        self.cursor = cursor
+        self.user_id = user_id
+        self.column = column
+        self.seq = seq
+        self.reset = reset
+        self.limit = limit
+        self.has_more = False
+        self.last = None
+    
+    def chunks(self):
+        """Пачки сообщений (списки словарей) по порядку выдачи"""
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = STREAM_CHUNK_ROWS if remaining is None else min(STREAM_CHUNK_ROWS, remaining)
+            rows = self.cursor.fetchmany(size)
+            if not rows:
+                return
+            if remaining is not None:
+                remaining -= len(rows)
+            self.last = rows[-1]
+            yield [message_data(msg, self.user_id) for msg in rows]
+        # Запрос выбирает limit + 1 строк: лишняя показывает, есть ли продолжение
+        self.has_more = self.cursor.fetchone() is not None
+    
+    def tail(self):
+        """Поля ответа, известные только после чтения всей страницы"""
+        seq = self.seq
+        if self.has_more and self.column == 'seq':
+            # Клиент продолжит с последнего полученного изменения
+            seq = self.last['seq']
+        return {'seq': seq, 'has_more': self.has_more}
+
+def message_data(msg, user_id):
+    """Сообщение для ответа API"""
+    return {
+        'id': msg['id'],
+        'sender_id': msg['sender_id'],
+        'receiver_id': msg['receiver_id'],
+        'message_text': msg['message_text'],
+        'created_at': msg['created_at'],
+        'sender_name': msg['sender_name'],
+        'is_own': msg['sender_id'] == user_id,
+        'attachment': attachment_info(msg),
+        'seq': msg['seq'],
+        'revision': msg['revision'],
+        'edited_at': msg['edited_at'],
+        'deleted': bool(msg['deleted'])
+    }
+
+def page_limit(limit):
+    """Размер страницы из запроса, не больше MAX_PAGE_SIZE"""
+    max_size = app.config['MAX_PAGE_SIZE']
+    if limit is None or limit == '':
+        return max_size
+    return max(1, min(int(limit), max_size))
+
+def open_messages(db, user_id, other_user_id, after_id=None, since_seq=None, limit=None):
+    """Страница переписки после after_id или изменения после since_seq: (MessagePage, 200) или (ошибка, статус)"""
+    if not other_user_id:
+        return {'success': False, 'error': 'Укажите user_id'}, 400
+    
+    try:
+        after_id = int(after_id or 0)
+        since_seq = int(since_seq) if since_seq is not None else None
+        low_id, high_id = conversation_pair(user_id, other_user_id)
+    except ValueError:
+        return {'success': False, 'error': 'Некорректные параметры запроса'}, 400
+    
+    cursor = db.cursor()
+    cursor.execute(
+        "SELECT seq, min_seq FROM conversation_seq WHERE low_id = ? AND high_id = ?",
+        (low_id, high_id)
+    )
+    counter = cursor.fetchone()
+    seq, min_seq = (counter['seq'], counter['min_seq']) if counter else (0, 0)
+    
+    reset = since_seq is not None and since_seq < min_seq
+    if since_seq is None or reset:
+        column, position = 'id', after_id
+    else:
+        column, position = 'seq', since_seq
+    
+    # Удаленные сообщения отдаем только при синхронизации по seq
+    visible = '' if column == 'seq' else 'AND m.deleted = 0'
+    cursor.execute(f'''
+        SELECT m.id, m.sender_id, m.receiver_id, m.message_text, m.created_at,
+               u.username as sender_name, m.attachment_id,
+               a.filename, a.size, a.mime_type, a.sha256,
+               m.seq, m.revision, m.edited_at, m.deleted
+        FROM messages m
+        JOIN users u ON m.sender_id = u.id
+        LEFT JOIN attachments a ON m.attachment_id = a.id
+        WHERE ((m.sender_id = ? AND m.receiver_id = ? AND m.{column} > ?)
+           OR (m.sender_id = ? AND m.receiver_id = ? AND m.{column} > ?))
+          {visible}
+        ORDER BY m.{column}
+        LIMIT ?
+    ''', (user_id, other_user_id, position, other_user_id, user_id, position,
+          -1 if limit is None else limit + 1))
+    
+    return MessagePage(cursor, user_id, column, seq, reset, limit), 200
+
+def do_list_messages(db, user_id, other_user_id, after_id=None, since_seq=None, limit=None):
+    """Страница переписки одним ответом (для ASGI); см. open_messages()"""
+    try:
+        limit = page_limit(limit)
+    except ValueError:
+        return {'success': False, 'error': 'Некорректные параметры запроса'}, 400
+    
+    page, status = open_messages(db, user_id, other_user_id, after_id, since_seq, limit)
+    if status != 200:
+        return page, status
+    
+    messages_data = [msg for chunk in page.chunks() for msg in chunk]
+    return {'success': True, 'reset': page.reset, 'messages': messages_data, **page.tail()}, 200
+
+def stream_json(head, key, chunks, tail=None):
+    """JSON-объект по частям: поля head, массив key из пачек chunks и поля
+    tail() после массива (они становятся известны в конце)"""
+    yield json.dumps(head)[:-1] + (', ' if head else '') + json.dumps(key) + ': ['
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        yield ('' if first else ', ') + ', '.join(json.dumps(item) for item in chunk)
+        first = False
+    fields = tail() if tail else {}
+    yield ']' + (', ' + json.dumps(fields)[1:] if fields else '}')
+
+def stream_messages(db, page, head, tail=True, headers=None):
+    """Потоковый ответ со страницей переписки; соединение закрывается вместе с ответом"""
+    def generate():
+        try:
+            yield from stream_json(head, 'messages', page.chunks(), page.tail if tail else None)
+        except sqlite3.Error as e:
+            # Заголовки уже отправлены: остается оборвать ответ, клиент получит невалидный JSON
+            print(f"❌ Ошибка при потоковой отдаче сообщений: {e}")
+            raise
+    
+    response = Response(generate(), mimetype='application/json', headers=headers)
+    # WSGI-сервер закрывает ответ и при отключении клиента, и если его так и не
+    # начали читать; finally генератора в последнем случае не выполнился бы
+    response.call_on_close(db.close)
+    return response
+
+def attachment_info(msg):
+    """Краткое описание вложения для ответа API (сам файл отдается отдельно)"""
+    if msg['attachment_id'] is None:
+        return None
+    
+    thumbnail_url = None
+    if msg['mime_type'].startswith('image/'):
+        if thumbnails.exists(msg['sha256']):
+            thumbnail_url = f"/api/attachments/{msg['attachment_id']}/thumbnail"
+        else:
+            # Превью строится в фоне и появится при следующем запросе
+            thumbnails.submit(msg['sha256'])
+    
+    return {
+        'id': msg['attachment_id'],
+        'filename': msg['filename'],
+        'size': msg['size'],
+        'mime_type': msg['mime_type'],
+        'url': f"/api/attachments/{msg['attachment_id']}",
+        'thumbnail_url': thumbnail_url
+    }
+
+def parse_message(data):
+    """Проверка полей сообщения: возвращает (поля, None) или (None, ошибка)"""
+    if not isinstance(data, dict):
+        return None, 'Некорректное сообщение'
+    
+    receiver_id = data.get('receiver_id')
+    message_text = data.get('message_text') or ''
+    if not isinstance(message_text, str):
+        return None, 'Некорректный message_text'
+    message_text = message_text.strip()
+    attachment_id = data.get('attachment_id')
+    client_id = data.get('client_id')
+    
+    if not receiver_id or not (message_text or attachment_id):
+        return None, 'Заполните все поля'
+    
+    try:
+        receiver_id = int(receiver_id)
+    except (TypeError, ValueError):
+        return None, 'Некорректный receiver_id'
+    
+    if attachment_id is not None and (not isinstance(attachment_id, int) or isinstance(attachment_id, bool)):
+        return None, 'Некорректный attachment_id'
+    
+    if client_id is not None and (not isinstance(client_id, str) or not 0 < len(client_id) <= 64):
+        return None, 'Некорректный client_id'
+    
+    return {
+        'receiver_id': receiver_id,
+        'message_text': message_text,
+        'attachment_id': attachment_id,
+        'client_id': client_id
+    }, None
+
+def owns_attachment(directory, user_id, attachment_id):
+    """Вложение принадлежит пользователю; directory - соединение с основной БД"""
+    cursor = directory.execute(
+        "SELECT id FROM attachments WHERE id = ? AND owner_id = ?",
+        (attachment_id, user_id)
+    )
+    return cursor.fetchone() is not None
+
+def store_message(cursor, user_id, msg, shard=None):
+    """Вставка сообщения в открытой транзакции: возвращает (id, дубликат ли)"""
+    # В шарде id назначается явно; транзакция уже держит блокировку записи
+    message_id = next_message_id(cursor, shard) if shard is not None else None
+    # Номер изменения повтора отправки пропадает: пропуски в seq допустимы
+    seq = next_conversation_seq(cursor, user_id, msg['receiver_id'])
+    try:
+        cursor.execute(
+            "INSERT INTO messages (id, sender_id, receiver_id, message_text, attachment_id, client_id, seq) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (message_id, user_id, msg['receiver_id'], msg['message_text'], msg['attachment_id'],
+             msg['client_id'], seq)
+        )
+        return cursor.lastrowid, False
+    except sqlite3.IntegrityError:
+        if msg['client_id'] is None:
+            raise
+        # Повтор уже принятой отправки: возвращаем исходное сообщение
+        cursor.execute(
+            "SELECT id FROM messages WHERE sender_id = ? AND client_id = ?",
+            (user_id, msg['client_id'])
+        )
+        original = cursor.fetchone()
+        if original is None:
+            raise
+        return original['id'], True
+
+@retry_locked
+def do_send_message(db, user_id, data):
+    """Отправка сообщения от user_id"""
+    msg, error = parse_message(data)
+    if error:
+        return {'success': False, 'error': error}, 400
+    
+    if msg['attachment_id']:
+        # У пишущего соединения шарда справочника нет: читаем основную БД отдельно
+        directory = db if router is None else get_db()
+        try:
+            owned = owns_attachment(directory, user_id, msg['attachment_id'])
+        finally:
+            if directory is not db:
+                directory.close()
+        if not owned:
+            return {'success': False, 'error': 'Вложение не найдено'}, 404
+    
+    cursor = db.cursor()
+    
+    try:
+        shard = router.shard_for(user_id, msg['receiver_id']) if router is not None else None
+        begin_write(cursor)
+        message_id, duplicate = store_message(cursor, user_id, msg, shard)
+        db.commit()
+    except sqlite3.OperationalError:
+        raise
+    except Exception as e:
+        return {'success': False, 'error': f'Ошибка отправки: {str(e)}'}, 500
+    
+    if duplicate:
+        return {'success': True, 'message': 'Сообщение уже отправлено',
+                'message_id': message_id, 'duplicate': True}, 200
+    
+    notify_new_message(message_id, user_id, msg['receiver_id'])
+    return {'success': True, 'message': 'Сообщение отправлено', 'message_id': message_id}, 200
+
+@retry_locked
+def store_batch(conn, user_id, shard, group):
+    """Сообщения группы [(индекс, сообщение)] одной транзакцией: результаты по порядку"""
+    cursor = conn.cursor()
+    begin_write(cursor)
+    results = []
+    for index, msg in group:
+        try:
+            message_id, duplicate = store_message(cursor, user_id, msg, shard)
+        except sqlite3.IntegrityError as e:
+            results.append({'success': False, 'error': f'Ошибка отправки: {str(e)}'})
+            continue
+        results.append({'success': True, 'message_id': message_id, 'duplicate': duplicate})
+    conn.commit()
+    return results
+
+def do_send_batch(db, user_id, data):
+    """Пакетная отправка: все сообщения одной транзакцией (в шардах - по транзакции на шард)"""
+    items = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return {'success': False, 'error': 'Передайте список messages'}, 400
+    
+    if len(items) > app.config['MAX_BATCH_SIZE']:
+        return {'success': False, 'error': f"Не больше {app.config['MAX_BATCH_SIZE']} сообщений за раз"}, 413
+    
+    results = [None] * len(items)
+    groups = {}
+    for index, item in enumerate(items):
+        msg, error = parse_message(item)
+        if error:
+            results[index] = {'success': False, 'error': error}
+            continue
+        # db - основная БД; вложения проверяем до блокировки записи шардов
+        if msg['attachment_id'] and not owns_attachment(db, user_id, msg['attachment_id']):
+            results[index] = {'success': False, 'error': 'Вложение не найдено'}
+            continue
+        shard = router.shard_for(user_id, msg['receiver_id']) if router is not None else None
+        groups.setdefault(shard, []).append((index, msg))
+    
+    for shard, group in groups.items():
+        conn = db if shard is None else get_messages_db(user_id, group[0][1]['receiver_id'], write=True)
+        try:
+            stored = store_batch(conn, user_id, shard, group)
+        finally:
+            if conn is not db:
+                conn.close()
+        # Уведомляем сразу после фиксации группы: если следующий шард останется
+        # занятым, повтор запроса вернет эти сообщения как дубликаты без уведомлений
+        for (index, msg), result in zip(group, stored):
+            results[index] = result
+            if result['success'] and not result['duplicate']:
+                notify_new_message(result['message_id'], user_id, msg['receiver_id'])
+    
+    return {'success': True, 'results': results}, 200
+
+def load_own_message(cursor, user_id, data):
+    """Сообщение user_id для правки или удаления: (строка, None) или (None, ответ)"""
+    try:
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        return None, ({'success': False, 'error': 'Укажите message_id'}, 400)
+    
+    cursor.execute(
+        "SELECT id, sender_id, receiver_id, message_text, revision, deleted FROM messages WHERE id = ?",
+        (message_id,)
+    )
+    msg = cursor.fetchone()
+    if msg is None or user_id not in (msg['sender_id'], msg['receiver_id']):
+        return None, ({'success': False, 'error': 'Сообщение не найдено'}, 404)
+    if msg['sender_id'] != user_id:
+        return None, ({'success': False, 'error': 'Можно изменять только свои сообщения'}, 403)
+    if msg['deleted']:
+        return None, ({'success': False, 'error': 'Сообщение удалено'}, 409)
+    return msg, None
+
+@retry_locked
+def do_edit_message(db, user_id, data):
+    """Правка своего сообщения; прежний текст сохраняется как ревизия"""
+    message_text = data.get('message_text')
+    if not isinstance(message_text, str) or not message_text.strip():
+        return {'success': False, 'error': 'Заполните все поля'}, 400
+    message_text = message_text.strip()
+    
+    cursor = db.cursor()
+    begin_write(cursor)
+    msg, error = load_own_message(cursor, user_id, data)
+    if error:
+        db.rollback()
+        return error
+    
+    cursor.execute(
+        "INSERT INTO message_revisions (message_id, revision, message_text) VALUES (?, ?, ?)",
+        (msg['id'], msg['revision'], msg['message_text'])
+    )
+    seq = next_conversation_seq(cursor, msg['sender_id'], msg['receiver_id'])
+    cursor.execute('''
+        UPDATE messages
+        SET message_text = ?, revision = revision + 1, edited_at = CURRENT_TIMESTAMP, seq = ?
+        WHERE id = ?
+    ''', (message_text, seq, msg['id']))
+    db.commit()
+    return {'success': True, 'message_id': msg['id'], 'seq': seq}, 200
+
+@retry_locked
+def do_delete_message(db, user_id, data):
+    """Удаление своего сообщения: строка остается надгробием с новым seq,
+    чтобы другие устройства узнали об удалении при синхронизации"""
+    cursor = db.cursor()
+    begin_write(cursor)
+    msg, error = load_own_message(cursor, user_id, data)
+    if error:
+        db.rollback()
+        return error
+    
+    seq = next_conversation_seq(cursor, msg['sender_id'], msg['receiver_id'])
+    cursor.execute('''
+        UPDATE messages
+        SET message_text = '', attachment_id = NULL, deleted = 1,
+            revision = revision + 1, edited_at = CURRENT_TIMESTAMP, seq = ?
+        WHERE id = ?
+    ''', (seq, msg['id']))
+    cursor.execute("DELETE FROM message_revisions WHERE message_id = ?", (msg['id'],))
+    db.commit()
+    return {'success': True, 'message_id': msg['id'], 'seq': seq}, 200
+
+def vacuum_messages(db, retention_days):
+    """Удалить ревизии и надгробия старше retention_days; возвращает (ревизий, надгробий)"""
+    cutoff = f'-{int(retention_days)} days'
+    cursor = db.cursor()
+    begin_write(cursor)
+    cursor.execute("DELETE FROM message_revisions WHERE created_at < datetime('now', ?)", (cutoff,))
+    revisions = cursor.rowcount
+    
+    # min_seq поднимается до seq последнего вычищенного надгробия: клиент,
+    # синхронизированный раньше, не увидел бы удаления и получит переписку целиком
+    cursor.execute('''
+        SELECT MIN(sender_id, receiver_id) AS low_id, MAX(sender_id, receiver_id) AS high_id,
+               MAX(seq) AS seq
+        FROM messages
+        WHERE deleted = 1 AND edited_at < datetime('now', ?)
+        GROUP BY 1, 2
+    ''', (cutoff,))
+    cursor.executemany(
+        "UPDATE conversation_seq SET min_seq = MAX(min_seq, ?) WHERE low_id = ? AND high_id = ?",
+        [(row['seq'], row['low_id'], row['high_id']) for row in cursor.fetchall()]
+    )
+    cursor.execute("DELETE FROM messages WHERE deleted = 1 AND edited_at < datetime('now', ?)", (cutoff,))
+    tombstones = cursor.rowcount
+    db.commit()
+    return revisions, tombstones
+
+def run_vacuum():
+    """Один проход очистки по всем хранилищам сообщений"""
+    db = get_db()
+    try:
+        for conn in message_stores(db):
+            revisions, tombstones = retry_policy.run(vacuum_messages, conn, app.config['MESSAGE_RETENTION_DAYS'])
+            if revisions or tombstones:
+                print(f"🧹 Удалено ревизий: {revisions}, надгробий: {tombstones}")
+    finally:
+        db.close()
+
+def run_rollups():
+    """Учесть в сводной статистике новые сообщения всех хранилищ"""
+    db = get_db()
+    try:
+        names = ['main'] if router is None else router.paths()
+        for conn, name in zip(message_stores(db), names):
+            retry_policy.run(catch_up_rollups, db, name, conn)
+    finally:
+        db.close()
+
+def cleanup_uploads(db, ttl_hours):
+    """Удалить загрузки без активности дольше ttl_hours: строки uploads и файлы .part
+    (в том числе файлы без строки, оставшиеся после сбоя)"""
+    cutoff = time.time() - ttl_hours * 3600
+    cursor = db.cursor()
+    begin_write(cursor)
+    cursor.execute("SELECT id FROM uploads WHERE created_at < datetime('now', ?)", (f'-{ttl_hours} hours',))
+    stale = [row['id'] for row in cursor.fetchall() if store.upload_mtime(row['id']) < cutoff]
+    cursor.executemany("DELETE FROM uploads WHERE id = ?", [(upload_id,) for upload_id in stale])
+    cursor.execute("SELECT id FROM uploads")
+    known = {row['id'] for row in cursor.fetchall()} | set(stale)
+    db.commit()
+    
+    orphans = [upload_id for upload_id in store.upload_ids()
+               if upload_id not in known and store.upload_mtime(upload_id) < cutoff]
+    for upload_id in stale + orphans:
+        store.discard(upload_id)
+    return len(stale), len(orphans)
+
+def run_upload_cleanup():
+    """Один проход очистки незавершенных загрузок"""
+    db = get_db()
+    try:
+        stale, orphans = retry_policy.run(cleanup_uploads, db, app.config['UPLOAD_TTL_HOURS'])
+        if stale or orphans:
+            print(f"🧹 Удалено незавершенных загрузок: {stale}, файлов без загрузки: {orphans}")
+    finally:
+        db.close()
+
+def start_background_job(name, interval, func):
+    """Периодическая задача в фоновом потоке, одна на процесс"""
+    if interval <= 0 or name in background_jobs:
+        return
+    
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception as e:
+                print(f"❌ Ошибка фоновой задачи {name}: {e}")
+    
+    background_jobs[name] = threading.Thread(target=loop, name=name, daemon=True)
+    background_jobs[name].start()
+
+def background_job_intervals():
+    """Фоновые задачи: (имя, интервал в секундах, функция); 0 - выключена"""
+    return [
+        ('messages-vacuum', app.config['VACUUM_INTERVAL_HOURS'] * 3600, run_vacuum),
+        ('uploads-cleanup', 3600 if app.config['UPLOAD_TTL_HOURS'] > 0 else 0, run_upload_cleanup),
+        ('stats-rollup', app.config['ROLLUP_INTERVAL_SECONDS'], run_rollups),
+    ]
+
+def start_background_jobs():
+    """Запустить фоновые задачи в одном процессе из всех воркеров (вызывается в воркере)"""
+    global jobs_leader
+    jobs = [job for job in background_job_intervals() if job[1] > 0]
+    if not jobs or jobs_leader is not None:
+        return
+    path = app.config['JOBS_LOCK'] or app.config['DATABASE'] + '.jobs.lock'
+    
+    def elect():
+        global jobs_lock
+        # Остальные процессы ждут здесь и подхватят задачи, если лидер завершится.
+        # Файл остается открытым до конца процесса: закрытие сняло бы блокировку
+        lock = open(path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        jobs_lock = lock
+        print(f"✅ Фоновые задачи выполняет процесс {os.getpid()}")
+        for name, interval, func in jobs:
+            start_background_job(name, interval, func)
+    
+    jobs_leader = threading.Thread(target=elect, name='jobs-leader', daemon=True)
+    jobs_leader.start()
+
+def notify_new_message(message_id, sender_id, receiver_id):
+    """Разбудить ожидающих клиентов получателя и других устройств отправителя"""
+    try:
+        event = {'message_id': message_id, 'sender_id': sender_id, 'receiver_id': int(receiver_id)}
+        for user_id in {int(sender_id), int(receiver_id)}:
+            bus.publish(f'user:{user_id}', event)
+    except Exception as e:
+        # Сообщение уже сохранено; клиенты увидят его при следующем опросе
+        print(f"⚠️ Не удалось отправить уведомление: {e}")
+
+def do_check_incoming(db, user_id, cursor):
+    """Новые входящие для user_id после cursor (без cursor - только текущий курсор)"""
+    # Курсор - id последнего входящего в каждом хранилище через запятую. Шарды
+    # фиксируют записи независимо, и общий максимум id пропускал бы сообщение,
+    # записанное в один шард позже сообщения с большим id в другом
+    reset = False
+    if cursor is not None:
+        try:
+            watermarks = [int(part) for part in cursor.split(',')]
+        except ValueError:
+            return {'success': False, 'error': 'Некорректный курсор'}, 400
+        if len(watermarks) != (router.count if router is not None else 1):
+            # Число шардов изменилось: клиент получает новый курсор
+            cursor, reset = None, True
+    
+    events, positions = [], []
+    for index, conn in enumerate(message_stores(db)):
+        if cursor is None:
+            row = conn.execute("SELECT MAX(id) FROM messages WHERE receiver_id = ?", (user_id,)).fetchone()
+            positions.append(row[0] or 0)
+            continue
+        rows = conn.execute(
+            "SELECT id, sender_id FROM messages WHERE receiver_id = ? AND id > ? ORDER BY id LIMIT 100",
+            (user_id, watermarks[index])
+        ).fetchall()
+        events.extend({'message_id': row['id'], 'sender_id': row['sender_id']} for row in rows)
+        positions.append(rows[-1]['id'] if rows else watermarks[index])
+    events.sort(key=lambda event: event['message_id'])
+    return {'success': True, 'events': events, 'cursor': ','.join(map(str, positions)), 'reset': reset}, 200
+
+def wait_timeout(raw):
+    """Время ожидания из значения ?timeout= (или None), не больше MAX_WAIT_TIMEOUT"""
+    try:
+        timeout = float(raw if raw is not None else app.config['MAX_WAIT_TIMEOUT'])
+    except ValueError:
+        timeout = app.config['MAX_WAIT_TIMEOUT']
+    return max(0, min(timeout, app.config['MAX_WAIT_TIMEOUT']))
 
 # API endpoints
 @app.route('/api/login', methods=['POST'])
 def api_login():
     """API для входа"""
     try:
-        data = request.get_json()
-        username = data.get('username')
-        password = data.get('password')
-        
-        if not username or not password:
-            return jsonify({'success': False, 'error': 'Заполните все поля'})
-        
         db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute(
-            "SELECT id, username, password_hash FROM users WHERE username = ?", 
-            (username,)
-        )
-        user = cursor.fetchone()
+        try:
+            payload, status, user = do_login(db, request.get_json())
+        finally:
+            db.close()
         
-        if user and user['password_hash'] == hash_password(password):
+        if user:
             session['user_id'] = user['id']
             session['username'] = user['username']
-            db.close()
-            return jsonify({'success': True, 'username': user['username']})
-        else:
-            db.close()
-            return jsonify({'success': False, 'error': 'Неверный логин или пароль'})
+        return jsonify(payload), status
             
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
@@ -120,7 +1133,7 @@ def api_login():
                 return jsonify({'success': False, 'error': 'База данных переинициализирована, попробуйте снова'})
             except:
                 return jsonify({'success': False, 'error': 'Ошибка базы данных. Попробуйте позже.'})
-        return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+        return db_error_response(e)
     except Exception as e:
         return jsonify({'success': False, 'error': f'Ошибка сервера: {str(e)}'})
 
@@ -128,40 +1141,12 @@ def api_login():
 def api_register():
     """API для регистрации"""
     try:
-        data = request.get_json()
-        username = data.get('username')
-        phone = data.get('phone')
-        password = data.get('password')
-        confirm = data.get('confirm')
-        
-        if not all([username, phone, password, confirm]):
-            return jsonify({'success': False, 'error': 'Заполните все поля'})
-        
-        if password != confirm:
-            return jsonify({'success': False, 'error': 'Пароли не совпадают'})
-        
-        if len(password) < 4:
-            return jsonify({'success': False, 'error': 'Пароль слишком короткий (мин. 4 символа)'})
-        
         db = get_db()
-        cursor = db.cursor()
-        
         try:
-            password_hash = hash_password(password)
-            cursor.execute(
-                "INSERT INTO users (username, phone, password_hash) VALUES (?, ?, ?)",
-                (username, phone, password_hash)
-            )
-            db.commit()
-            db.close()
-            return jsonify({'success': True, 'message': 'Регистрация успешна! Теперь войдите.'})
-        
-        except sqlite3.IntegrityError:
+            payload, status = do_register(db, request.get_json())
+        finally:
             db.close()
-            return jsonify({'success': False, 'error': 'Логин или телефон уже заняты'})
-        except Exception as e:
-            db.close()
-            return jsonify({'success': False, 'error': f'Ошибка: {str(e)}'})
+        return jsonify(payload), status
             
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
@@ -170,7 +1155,9 @@ def api_register():
                 return jsonify({'success': False, 'error': 'База данных переинициализирована, попробуйте снова'})
             except:
                 return jsonify({'success': False, 'error': 'Ошибка базы данных. Попробуйте позже.'})
-        return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+        return db_error_response(e)
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Ошибка: {str(e)}'})
 
 @app.route('/api/users')
 def api_users():
@@ -180,23 +1167,37 @@ def api_users():
             return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
         
         db = get_db()
-        cursor = db.cursor()
+        try:
+            payload, status = do_list_users(db, session['user_id'])
+        finally:
+            db.close()
+        return jsonify(payload), status
         
-        cursor.execute(
-            "SELECT id, username, phone FROM users WHERE id != ? ORDER BY username",
-            (session['user_id'],)
-        )
-        users = cursor.fetchall()
-        db.close()
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            init_db()
+            return jsonify({'success': True, 'users': []})
+        return db_error_response(e)
+
+@app.route('/api/users/sync')
+def api_users_sync():
+    """API для дельта-синхронизации списка пользователей"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
         
-        users_data = [dict(user) for user in users]
-        return jsonify({'success': True, 'users': users_data})
+        db = get_db()
+        try:
+            payload, status = do_sync_users(db, session['user_id'], request.args.get('since'))
+        finally:
+            db.close()
+        return jsonify(payload), status
         
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
             init_db()
-            return jsonify({'success': True, 'users': []})
-        return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+            return jsonify({'success': True, 'version': 0, 'full': True, 'upserts': [], 'deletes': []})
+        return db_error_response(e)
 
 @app.route('/api/messages')
 def api_messages():
@@ -205,43 +1206,64 @@ def api_messages():
         if 'user_id' not in session:
             return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
         
-        other_user_id = request.args.get('user_id')
-        if not other_user_id:
-            return jsonify({'success': False, 'error': 'Укажите user_id'}), 400
-        
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute('''
-            SELECT m.id, m.sender_id, m.receiver_id, m.message_text, m.created_at, 
-                   u.username as sender_name
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-               OR (m.sender_id = ? AND m.receiver_id = ?)
-            ORDER BY m.created_at
-        ''', (session['user_id'], other_user_id, other_user_id, session['user_id']))
-        
-        messages = cursor.fetchall()
-        db.close()
+        try:
+            limit = page_limit(request.args.get('limit'))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Некорректные параметры запроса'}), 400
         
-        messages_data = [{
-            'id': msg['id'],
-            'sender_id': msg['sender_id'],
-            'receiver_id': msg['receiver_id'],
-            'message_text': msg['message_text'],
-            'created_at': msg['created_at'],
-            'sender_name': msg['sender_name'],
-            'is_own': msg['sender_id'] == session['user_id']
-        } for msg in messages]
+        db = get_messages_db(session['user_id'], request.args.get('user_id'))
+        try:
+            page, status = open_messages(
+                db, session['user_id'], request.args.get('user_id'),
+                request.args.get('after_id'), request.args.get('since_seq'), limit
+            )
+        except Exception:
+            db.close()
+            raise
+        if status != 200:
+            db.close()
+            return jsonify(page), status
         
-        return jsonify({'success': True, 'messages': messages_data})
+        # Ответ собирается по мере чтения курсора, память не растет с длиной переписки
+        head = {'success': True, 'reset': page.reset}
+        return stream_messages(db, page, head)
         
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
             init_db()
             return jsonify({'success': True, 'messages': []})
-        return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+        return db_error_response(e)
+
+@app.route('/api/messages/export')
+def api_export_messages():
+    """Выгрузка всей переписки (без удаленных сообщений) одним JSON-файлом"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        other_user_id = request.args.get('user_id')
+        db = get_messages_db(session['user_id'], other_user_id)
+        try:
+            page, status = open_messages(db, session['user_id'], other_user_id)
+        except Exception:
+            db.close()
+            raise
+        if status != 200:
+            db.close()
+            return jsonify(page), status
+        
+        head = {
+            'user_id': session['user_id'],
+            'other_user_id': int(other_user_id),
+            'exported_at': datetime.now().isoformat(timespec='seconds')
+        }
+        return stream_messages(
+            db, page, head, tail=False,
+            headers={'Content-Disposition': f'attachment; filename="messages-{int(other_user_id)}.json"'}
+        )
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
 
 @app.route('/api/send_message', methods=['POST'])
 def api_send_message():
@@ -250,34 +1272,425 @@ def api_send_message():
         if 'user_id' not in session:
             return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
         
-        data = request.get_json()
-        receiver_id = data.get('receiver_id')
-        message_text = data.get('message_text', '').strip()
+        data = json_object()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
         
-        if not receiver_id or not message_text:
-            return jsonify({'success': False, 'error': 'Заполните все поля'}), 400
+        db = get_messages_db(session['user_id'], data.get('receiver_id'), write=True)
+        try:
+            payload, status = do_send_message(db, session['user_id'], data)
+        finally:
+            db.close()
+        return jsonify(payload), status
+            
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            init_db()
+            return jsonify({'success': False, 'error': 'База данных переинициализирована, попробуйте снова'})
+        return db_error_response(e)
+
+@app.route('/api/edit_message', methods=['POST'])
+def api_edit_message():
+    """API для редактирования своего сообщения (user_id - собеседник, по нему выбирается шард)"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        data = json_object()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
+    
+        db = get_messages_db(session['user_id'], data.get('user_id'), write=True)
+        try:
+            payload, status = do_edit_message(db, session['user_id'], data)
+        finally:
+            db.close()
+        return jsonify(payload), status
+    
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/delete_message', methods=['POST'])
+def api_delete_message():
+    """API для удаления своего сообщения (user_id - собеседник, по нему выбирается шард)"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        data = json_object()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
+    
+        db = get_messages_db(session['user_id'], data.get('user_id'), write=True)
+        try:
+            payload, status = do_delete_message(db, session['user_id'], data)
+        finally:
+            db.close()
+        return jsonify(payload), status
+    
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+# Вложения: докачиваемая загрузка кусками и отдача файла с поддержкой Range
+@app.route('/api/uploads', methods=['POST'])
+def api_create_upload():
+    """API для начала загрузки вложения"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        data = json_object()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
         
+        filename = data.get('filename')
+        filename = os.path.basename(filename) if isinstance(filename, str) else ''
+        mime_type = data.get('mime_type') or 'application/octet-stream'
+        size = data.get('size')
+        
+        if (not filename or not isinstance(mime_type, str)
+                or not isinstance(size, int) or isinstance(size, bool) or size <= 0):
+            return jsonify({'success': False, 'error': 'Укажите имя и размер файла'}), 400
+        
+        if size > app.config['MAX_ATTACHMENT_SIZE']:
+            return jsonify({'success': False, 'error': 'Файл слишком большой'}), 413
+        
+        upload_id = uuid.uuid4().hex
         db = get_db()
-        cursor = db.cursor()
+        try:
+            db.execute(
+                "INSERT INTO uploads (id, owner_id, filename, mime_type, size) VALUES (?, ?, ?, ?, ?)",
+                (upload_id, session['user_id'], filename, mime_type, size)
+            )
+            db.commit()
+        finally:
+            db.close()
+        
+        return jsonify({'success': True, 'upload_id': upload_id, 'received': 0,
+                        'chunk_size': app.config['MAX_CHUNK_SIZE']})
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+def get_upload(db, upload_id):
+    """Загрузка текущего пользователя или None"""
+    cursor = db.execute(
+        "SELECT id, filename, mime_type, size FROM uploads WHERE id = ? AND owner_id = ?",
+        (upload_id, session['user_id'])
+    )
+    return cursor.fetchone()
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT'])
+def api_upload_chunk(upload_id):
+    """API для докачки: GET - сколько получено, PUT ?offset=N - очередной кусок"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
         
+        db = get_db()
         try:
+            upload = get_upload(db, upload_id)
+        finally:
+            db.close()
+        
+        if upload is None:
+            return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
+        
+        received = store.part_size(upload_id)
+        if request.method == 'GET':
+            return jsonify({'success': True, 'received': received, 'size': upload['size']})
+        
+        offset = request.args.get('offset', type=int)
+        if offset is None or not 0 <= offset <= upload['size']:
+            return jsonify({'success': False, 'error': 'Неверное смещение', 'received': received}), 409
+        
+        limit = min(
+            request.content_length or 0,
+            app.config['MAX_CHUNK_SIZE'],
+            upload['size'] - offset
+        )
+        # Смещение сверяется под блокировкой файла загрузки: повтор куска,
+        # пришедший одновременно с исходным запросом, не допишется второй раз
+        written, received = store.append_chunk(upload_id, request.stream, offset, limit)
+        if not written:
+            # Клиент должен продолжить с того места, где сервер остановился
+            return jsonify({'success': False, 'error': 'Неверное смещение', 'received': received}), 409
+        return jsonify({'success': True, 'received': received, 'size': upload['size']})
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def api_complete_upload(upload_id):
+    """API для завершения загрузки; необязательный sha256 сверяется с полученным файлом"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        data = request.get_json(silent=True) or {}
+        expected_sha256 = data.get('sha256') if isinstance(data, dict) else None
+        if expected_sha256 is not None:
+            if not isinstance(expected_sha256, str) or not _sha256_re.match(expected_sha256.lower()):
+                return jsonify({'success': False, 'error': 'Некорректный sha256'}), 400
+            expected_sha256 = expected_sha256.lower()
+        
+        db = get_db()
+        try:
+            upload = get_upload(db, upload_id)
+            if upload is None:
+                return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
+            
+            if store.part_size(upload_id) != upload['size']:
+                return jsonify({'success': False, 'error': 'Файл загружен не полностью',
+                                'received': store.part_size(upload_id)}), 409
+            
+            try:
+                sha256, size = store.commit(upload_id, expected_sha256)
+            except ValueError as e:
+                # Поврежденный файл удален; загрузку можно повторить с нуля
+                return jsonify({'success': False, 'error': str(e), 'received': 0}), 422
+            except FileNotFoundError:
+                # Параллельный запрос уже завершил эту загрузку
+                return jsonify({'success': False, 'error': 'Загрузка уже завершена'}), 409
+            cursor = db.cursor()
             cursor.execute(
-                "INSERT INTO messages (sender_id, receiver_id, message_text) VALUES (?, ?, ?)",
-                (session['user_id'], receiver_id, message_text)
+                "INSERT INTO attachments (owner_id, sha256, size, filename, mime_type) VALUES (?, ?, ?, ?, ?)",
+                (session['user_id'], sha256, size, upload['filename'], upload['mime_type'])
             )
+            attachment_id = cursor.lastrowid
+            cursor.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
             db.commit()
+        finally:
             db.close()
-            return jsonify({'success': True, 'message': 'Сообщение отправлено'})
         
-        except Exception as e:
+        if upload['mime_type'].startswith('image/'):
+            thumbnails.submit(sha256)
+        
+        return jsonify({'success': True, 'attachment': {
+            'id': attachment_id,
+            'filename': upload['filename'],
+            'size': size,
+            'mime_type': upload['mime_type'],
+            'url': f'/api/attachments/{attachment_id}'
+        }})
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+def get_attachment(db, attachment_id, user_id):
+    """Вложение, доступное пользователю: владельцу и участникам переписки"""
+    cursor = db.execute(
+        "SELECT sha256, filename, mime_type, owner_id FROM attachments WHERE id = ?",
+        (attachment_id,)
+    )
+    attachment = cursor.fetchone()
+    if attachment is None or attachment['owner_id'] == user_id:
+        return attachment
+    
+    for conn in message_stores(db):
+        cursor = conn.execute('''
+            SELECT 1 FROM messages
+            WHERE attachment_id = ? AND (sender_id = ? OR receiver_id = ?)
+            LIMIT 1
+        ''', (attachment_id, user_id, user_id))
+        if cursor.fetchone():
+            return attachment
+    return None
+
+# Типы, которые безопасно показывать в браузере; остальное (в том числе
+# text/html и image/svg+xml, указанные клиентом при загрузке) - только скачиванием
+INLINE_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+_sha256_re = re.compile(r'^[0-9a-f]{64}$')
+
+@app.route('/api/attachments/<int:attachment_id>')
+def api_attachment(attachment_id):
+    """API для скачивания вложения (Range, If-None-Match, sendfile через wsgi.file_wrapper)"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        db = get_db()
+        try:
+            attachment = get_attachment(db, attachment_id, session['user_id'])
+        finally:
             db.close()
-            return jsonify({'success': False, 'error': f'Ошибка отправки: {str(e)}'}), 500
+        
+        if attachment is None:
+            return jsonify({'success': False, 'error': 'Вложение не найдено'}), 404
+        
+        response = send_file(
+            os.path.abspath(store.object_path(attachment['sha256'])),
+            mimetype=attachment['mime_type'],
+            as_attachment=attachment['mime_type'] not in INLINE_MIME_TYPES,
+            download_name=attachment['filename'],
+            etag=attachment['sha256'],
+            conditional=True,
+            max_age=31536000
+        )
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+        return response
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/attachments/<int:attachment_id>/thumbnail')
+def api_attachment_thumbnail(attachment_id):
+    """API для получения превью изображения"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        db = get_db()
+        try:
+            attachment = get_attachment(db, attachment_id, session['user_id'])
+        finally:
+            db.close()
+        
+        if attachment is None:
+            return jsonify({'success': False, 'error': 'Вложение не найдено'}), 404
+        
+        if not thumbnails.exists(attachment['sha256']):
+            thumbnails.submit(attachment['sha256'])
+            return jsonify({'success': False, 'error': 'Превью еще не готово'}), 404
+        
+        response = send_file(
+            os.path.abspath(thumbnails.thumbnail_path(attachment['sha256'])),
+            mimetype='image/jpeg',
+            etag=attachment['sha256'],
+            conditional=True,
+            max_age=31536000
+        )
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+        return response
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/admin/slow_queries')
+def api_admin_slow_queries():
+    """API для просмотра медленных запросов (только для администраторов)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+    
+    if not is_admin():
+        return jsonify({'success': False, 'error': 'Доступ запрещен'}), 403
+    
+    if profiler is None:
+        return jsonify({'success': False, 'error': 'Профилирование выключено (SLOW_QUERY_MS)'}), 404
+    
+    queries = profiler.snapshot()
+    queries.reverse()
+    return jsonify({'success': True, 'threshold_ms': profiler.threshold_ms, 'queries': queries})
+
+@app.route('/api/admin/lock_stats')
+def api_admin_lock_stats():
+    """API распределения ожидания блокировки записи в этом процессе (только для администраторов)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+    
+    if not is_admin():
+        return jsonify({'success': False, 'error': 'Доступ запрещен'}), 403
+    
+    stats = lock_summary(lock_stats.snapshot())
+    if request.args.get('reset'):
+        lock_stats.reset()
+    return jsonify({'success': True, 'pid': os.getpid(), **stats})
+
+@app.route('/api/admin/stats')
+def api_admin_stats():
+    """API статистики сообщений из сводных таблиц (только для администраторов)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+    
+    if not is_admin():
+        return jsonify({'success': False, 'error': 'Доступ запрещен'}), 403
+    
+    # Сводки отстают от реальных данных не больше чем на ROLLUP_INTERVAL_SECONDS
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), 366))
+        hours = max(1, min(int(request.args.get('hours', 48)), 336))
+        top = max(1, min(int(request.args.get('top', 10)), 100))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Некорректные параметры запроса'}), 400
+    
+    try:
+        db = get_db()
+        try:
+            stats = read_stats(db, days, hours, top)
+        finally:
+            db.close()
+        return jsonify({'success': True, **stats})
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/wait')
+def api_wait():
+    """API ожидания новых входящих (long polling; для множества ожидающих - asgi.py)"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        user_id = session['user_id']
+        cursor = request.args.get('cursor')
+        woken = threading.Event()
+        # Подписываемся до проверки БД, чтобы не пропустить сообщение между ними;
+        # без подтвержденной подписки ждать нельзя - событие могло бы потеряться
+        try:
+            unsubscribe = bus.subscribe(f'user:{user_id}', lambda event: woken.set())
+        except ConnectionError:
+            response = jsonify({'success': False, 'error': 'Шина уведомлений недоступна, попробуйте позже'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        try:
+            db = get_db()
+            try:
+                payload, status = do_check_incoming(db, user_id, cursor)
+            finally:
+                db.close()
             
+            if cursor is not None and status == 200 and not payload['events'] and not payload['reset']:
+                if woken.wait(wait_timeout(request.args.get('timeout'))):
+                    db = get_db()
+                    try:
+                        payload, status = do_check_incoming(db, user_id, cursor)
+                    finally:
+                        db.close()
+        finally:
+            unsubscribe()
+        
+        return jsonify(payload), status
+        
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
+
+@app.route('/api/send_batch', methods=['POST'])
+def api_send_batch():
+    """API для пакетной отправки (очередь офлайн-сообщений клиента)"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'error': 'Требуется авторизация'}), 401
+        
+        data = json_object()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Ожидается JSON-объект'}), 400
+        
+        db = get_db()
+        try:
+            payload, status = do_send_batch(db, session['user_id'], data)
+        finally:
+            db.close()
+        return jsonify(payload), status
+        
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
             init_db()
             return jsonify({'success': False, 'error': 'База данных переинициализирована, попробуйте снова'})
-        return jsonify({'success': False, 'error': f'Ошибка базы данных: {str(e)}'})
+        return db_error_response(e)
 
 @app.route('/api/logout')
 def api_logout():
@@ -307,10 +1720,6 @@ def api_health():
     except Exception as e:
         return jsonify({'status': 'unhealthy', 'database': 'disconnected', 'error': str(e)})
 
-# Создаем папку templates если ее нет
-if not os.path.exists('templates'):
-    os.makedirs('templates')
-
 # HTML шаблон для SPA с адаптивным дизайном
 spa_html = '''
 <!DOCTYPE html>
@@ -548,12 +1957,17 @@ spa_html = '''
             overflow-y: auto; 
             background: var(--bg-color); 
         }
+        .message-row {
+            display: flow-root;
+        }
         .message { 
             max-width: 80%; 
             margin: 10px 0; 
             padding: 12px; 
             border-radius: 15px; 
             position: relative;
+        }
+        .message-new {
             animation: fadeIn 0.3s ease;
         }
         @keyframes fadeIn {
@@ -579,6 +1993,25 @@ spa_html = '''
             margin-top: 5px;
             text-align: right;
         }
+        .message-deleted {
+            font-style: italic;
+            opacity: 0.7;
+        }
+        .message-actions {
+            float: right;
+            margin-left: 8px;
+        }
+        .message-actions button {
+            background: none;
+            border: none;
+            width: auto;
+            padding: 0 2px;
+            cursor: pointer;
+            opacity: 0.6;
+        }
+        .message-actions button:hover {
+            opacity: 1;
+        }
         .message-input { 
             display: flex; 
             padding: 15px; 
@@ -597,6 +2030,18 @@ spa_html = '''
             padding: 0 15px;
             white-space: nowrap;
         }
+        .message-input .attach-button {
+            margin-right: 10px;
+        }
+        .message-attachment {
+            display: block;
+            margin-top: 5px;
+            color: inherit;
+        }
+        .message-attachment img {
+            max-width: 100%;
+            border-radius: 10px;
+        }
         .logout-btn { 
             background: var(--error-color); 
             padding: 8px 15px; 
@@ -733,6 +2178,8 @@ spa_html = '''
                     <div class="messages-container" id="messagesContainer"></div>
                     
                     <div class="message-input" id="messageInput" style="display: none;">
+                        <input type="file" id="attachmentInput" style="display: none;" onchange="sendAttachment(this.files[0])">
+                        <button class="attach-button" onclick="document.getElementById('attachmentInput').click()">📎</button>
                         <input type="text" id="messageText" placeholder="Введите сообщение..." onkeypress="if(event.key === 'Enter') sendMessage()">
                         <button onclick="sendMessage()">📤</button>
                     </div>
@@ -792,6 +2239,9 @@ spa_html = '''
             if (isMobile) {
                 showUserList();
             }
+            
+            // Досылаем сообщения, накопленные без сети
+            flushOutbox();
         }
         
         function toggleSidebar() {
@@ -803,7 +2253,7 @@ spa_html = '''
             document.getElementById('sidebar').classList.add('active');
             document.getElementById('chatTitle').textContent = 'Выберите пользователя для чата';
             document.getElementById('messageInput').style.display = 'none';
-            document.getElementById('messagesContainer').innerHTML = '';
+            if (messageList) messageList.clear();
             document.querySelector('.back-button').style.display = 'none';
             selectedUserId = null;
             
@@ -865,37 +2315,308 @@ spa_html = '''
             await fetch('/api/logout');
             currentUser = null;
             selectedUserId = null;
+            usersRendered = false;
             showAuth();
         }
         
+        // Локальная копия справочника: { version, users: { id: пользователь } }
+        function directoryKey() {
+            return `directory:${currentUser}`;
+        }
+        
+        function loadDirectory() {
+            try {
+                return JSON.parse(localStorage.getItem(directoryKey())) || { version: 0, users: {} };
+            } catch (error) {
+                return { version: 0, users: {} };
+            }
+        }
+        
+        let usersRendered = false;
+        
         async function loadUsers() {
             try {
-                const response = await fetch('/api/users');
+                const directory = loadDirectory();
+                const response = await fetch(`/api/users/sync?since=${directory.version}`);
                 const data = await response.json();
                 
                 if (data.success) {
-                    const userList = document.getElementById('userList');
-                    userList.innerHTML = '';
+                    if (data.full) directory.users = {};
+                    data.upserts.forEach(user => directory.users[user.id] = user);
+                    data.deletes.forEach(id => delete directory.users[id]);
+                    directory.version = data.version;
+                    localStorage.setItem(directoryKey(), JSON.stringify(directory));
                     
-                    data.users.forEach(user => {
-                        const userElement = document.createElement('div');
-                        userElement.className = 'user-item';
-                        userElement.innerHTML = `
-                            <div class="user-avatar">${user.username.charAt(0).toUpperCase()}</div>
-                            <div class="user-info">
-                                <div class="user-name">${user.username}</div>
-                                <div class="user-phone">${user.phone}</div>
-                            </div>
-                        `;
-                        userElement.onclick = () => selectUser(user.id, user.username);
-                        userList.appendChild(userElement);
-                    });
+                    // Перерисовываем боковую панель только если что-то изменилось
+                    if (usersRendered && !data.full && !data.upserts.length && !data.deletes.length) return;
+                    renderUsers(Object.values(directory.users));
                 }
             } catch (error) {
                 console.error('Failed to load users:', error);
             }
         }
         
+        function renderUsers(users) {
+            const userList = document.getElementById('userList');
+            userList.innerHTML = '';
+            usersRendered = true;
+            
+            users.sort((a, b) => a.username < b.username ? -1 : a.username > b.username ? 1 : 0);
+            users.forEach(user => {
+                const userElement = document.createElement('div');
+                userElement.className = 'user-item';
+                if (user.id === selectedUserId) userElement.classList.add('active');
+                userElement.innerHTML = `
+                    <div class="user-avatar">${escapeHtml(user.username.charAt(0).toUpperCase())}</div>
+                    <div class="user-info">
+                        <div class="user-name">${escapeHtml(user.username)}</div>
+                        <div class="user-phone">${escapeHtml(user.phone)}</div>
+                    </div>
+                `;
+                userElement.onclick = () => selectUser(user.id, user.username);
+                userList.appendChild(userElement);
+            });
+        }
+        
+        setInterval(() => { if (currentUser) loadUsers(); }, 30000);
+        
+        // Локальный кэш переписок в IndexedDB (ключ - текущий пользователь и собеседник)
+        const messageCache = {
+            db: null,
+            
+            async open() {
+                if (this.db) return this.db;
+                this.db = await new Promise((resolve, reject) => {
+                    const request = indexedDB.open('messenger', 1);
+                    request.onupgradeneeded = () => request.result.createObjectStore('conversations');
+                    request.onsuccess = () => resolve(request.result);
+                    request.onerror = () => reject(request.error);
+                });
+                return this.db;
+            },
+            
+            async get(key) {
+                try {
+                    const db = await this.open();
+                    return await new Promise((resolve, reject) => {
+                        const request = db.transaction('conversations').objectStore('conversations').get(key);
+                        request.onsuccess = () => resolve(request.result);
+                        request.onerror = () => reject(request.error);
+                    });
+                } catch (error) {
+                    return undefined;
+                }
+            },
+            
+            // Значение: { seq, messages }, seq - номер последнего примененного изменения
+            async put(key, conversation) {
+                try {
+                    const db = await this.open();
+                    db.transaction('conversations', 'readwrite').objectStore('conversations').put(conversation, key);
+                } catch (error) {
+                    console.error('Failed to cache messages:', error);
+                }
+            }
+        };
+        
+        // Виртуализированный список: в DOM только видимые сообщения,
+        // высоты строк измеряются после отрисовки и запоминаются
+        class VirtualMessageList {
+            constructor(container) {
+                this.container = container;
+                this.items = [];
+                this.heights = new Map();
+                this.rows = new Map();
+                this.estimatedHeight = 70;
+                this.overscan = 400;
+                this.topSpacer = document.createElement('div');
+                this.rowsElement = document.createElement('div');
+                this.bottomSpacer = document.createElement('div');
+                container.append(this.topSpacer, this.rowsElement, this.bottomSpacer);
+                container.addEventListener('scroll', () => this.scheduleRender());
+                window.addEventListener('resize', () => this.scheduleRender());
+            }
+            
+            setItems(items) {
+                this.items = items.slice();
+                this.heights.clear();
+                this.rows.forEach(row => row.remove());
+                this.rows.clear();
+                this.render();
+                this.scrollToBottom();
+            }
+            
+            indexOf(id) {
+                // Сообщения упорядочены по id: бинарный поиск позиции
+                let low = 0;
+                let high = this.items.length;
+                while (low < high) {
+                    const middle = (low + high) >> 1;
+                    if (this.items[middle].id < id) low = middle + 1;
+                    else high = middle;
+                }
+                return low;
+            }
+            
+            upsert(items) {
+                // Новые сообщения вставляются по месту, измененные заменяются;
+                // перемонтируются только строки измененных сообщений
+                if (!items.length) return false;
+                
+                const atBottom = this.isAtBottom();
+                items.forEach(item => {
+                    const index = this.indexOf(item.id);
+                    if (index < this.items.length && this.items[index].id === item.id) {
+                        this.items[index] = item;
+                        const row = this.rows.get(item.id);
+                        if (row) row.remove();
+                        this.rows.delete(item.id);
+                        this.heights.delete(item.id);
+                    } else {
+                        item.isNew = true;
+                        this.items.splice(index, 0, item);
+                    }
+                });
+                this.render();
+                if (atBottom) this.scrollToBottom();
+                return true;
+            }
+            
+            clear() {
+                this.setItems([]);
+            }
+            
+            isAtBottom() {
+                const c = this.container;
+                return c.scrollHeight - c.scrollTop - c.clientHeight < 50;
+            }
+            
+            scrollToBottom() {
+                this.container.scrollTop = this.container.scrollHeight;
+                this.render();
+            }
+            
+            heightOf(item) {
+                return this.heights.get(item.id) || this.estimatedHeight;
+            }
+            
+            scheduleRender() {
+                if (this.renderPending) return;
+                this.renderPending = true;
+                requestAnimationFrame(() => {
+                    this.renderPending = false;
+                    this.render();
+                });
+            }
+            
+            render() {
+                const atBottom = this.items.length > 0 && this.isAtBottom();
+                const scrollTop = this.container.scrollTop;
+                const viewBottom = scrollTop + this.container.clientHeight + this.overscan;
+                
+                let start = 0;
+                let top = 0;
+                while (start < this.items.length && top + this.heightOf(this.items[start]) < scrollTop - this.overscan) {
+                    top += this.heightOf(this.items[start]);
+                    start++;
+                }
+                
+                let end = start;
+                let bottom = top;
+                while (end < this.items.length && bottom < viewBottom) {
+                    bottom += this.heightOf(this.items[end]);
+                    end++;
+                }
+                
+                let total = bottom;
+                for (let i = end; i < this.items.length; i++) total += this.heightOf(this.items[i]);
+                
+                // Снимаем строки, ушедшие из видимой области, и монтируем новые
+                const visible = new Set(this.items.slice(start, end).map(item => item.id));
+                this.rows.forEach((row, id) => {
+                    if (!visible.has(id)) {
+                        row.remove();
+                        this.rows.delete(id);
+                    }
+                });
+                
+                let previous = null;
+                for (let i = start; i < end; i++) {
+                    const item = this.items[i];
+                    let row = this.rows.get(item.id);
+                    if (!row) {
+                        row = renderMessage(item);
+                        this.rows.set(item.id, row);
+                        delete item.isNew;
+                    }
+                    if (row.previousSibling !== previous || row.parentNode !== this.rowsElement) {
+                        this.rowsElement.insertBefore(row, previous ? previous.nextSibling : this.rowsElement.firstChild);
+                    }
+                    previous = row;
+                }
+                
+                this.topSpacer.style.height = `${top}px`;
+                this.bottomSpacer.style.height = `${total - bottom}px`;
+                
+                // Уточняем высоты; если оценка была неверной, перерисовываем
+                let changed = false;
+                this.rows.forEach((row, id) => {
+                    const height = row.offsetHeight;
+                    if (height && this.heights.get(id) !== height) {
+                        this.heights.set(id, height);
+                        changed = true;
+                    }
+                });
+                if (changed) {
+                    if (atBottom) this.container.scrollTop = this.container.scrollHeight;
+                    this.scheduleRender();
+                }
+            }
+        }
+        
+        let messageList = null;
+        let conversationSeq = 0;
+        
+        function conversationKey(userId) {
+            return `${currentUser}:${userId}`;
+        }
+        
+        function escapeHtml(value) {
+            const entities = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'};
+            return String(value).replace(/[&<>"']/g, ch => entities[ch]);
+        }
+        
+        function renderMessage(msg) {
+            const row = document.createElement('div');
+            row.className = 'message-row';
+            
+            const messageElement = document.createElement('div');
+            messageElement.className = `message ${msg.is_own ? 'message-own' : 'message-other'}${msg.isNew ? ' message-new' : ''}`;
+            
+            const time = new Date(msg.created_at).toLocaleTimeString();
+            if (msg.deleted) {
+                messageElement.innerHTML = `
+                    <span class="message-deleted">Сообщение удалено</span>
+                    <div class="message-time">${time}</div>
+                `;
+                row.appendChild(messageElement);
+                return row;
+            }
+            
+            messageElement.innerHTML = `
+                ${msg.is_own ? `<span class="message-actions"><button title="Изменить" onclick="editMessage(${msg.id})">✏️</button><button title="Удалить" onclick="deleteMessage(${msg.id})">🗑</button></span>` : ''}
+                <strong>${msg.is_own ? 'Вы' : escapeHtml(msg.sender_name)}:</strong> ${escapeHtml(msg.message_text)}
+                ${msg.attachment ? `<a class="message-attachment" href="${msg.attachment.url}" target="_blank">${msg.attachment.thumbnail_url ? `<img src="${msg.attachment.thumbnail_url}" alt="${escapeHtml(msg.attachment.filename)}" loading="lazy">` : `📎 ${escapeHtml(msg.attachment.filename)}`}</a>` : ''}
+                <div class="message-time">${msg.edited_at ? '(изменено) ' : ''}${time}</div>
+            `;
+            
+            // Картинка меняет высоту строки после загрузки
+            messageElement.querySelectorAll('img').forEach(img => img.onload = () => messageList.scheduleRender());
+            
+            row.appendChild(messageElement);
+            return row;
+        }
+        
         async function selectUser(userId, username) {
             selectedUserId = userId;
             
@@ -911,6 +2632,15 @@ spa_html = '''
                 document.getElementById('sidebar').classList.remove('active');
             }
             
+            // Сразу показываем переписку из кэша, затем догружаем только изменения после seq
+            if (!messageList) messageList = new VirtualMessageList(document.getElementById('messagesContainer'));
+            const cached = await messageCache.get(conversationKey(userId));
+            if (selectedUserId !== userId) return;
+            // Кэш старого формата (массив без seq) загружаем заново
+            const conversation = cached && !Array.isArray(cached) ? cached : { seq: 0, messages: [] };
+            conversationSeq = conversation.seq;
+            messageList.setItems(conversation.messages);
+            
             await loadMessages();
             
             if (refreshInterval) clearInterval(refreshInterval);
@@ -918,57 +2648,212 @@ spa_html = '''
         }
         
         async function loadMessages() {
-            if (!selectedUserId) return;
+            if (!selectedUserId || !messageList) return;
+            const userId = selectedUserId;
+            if (loadOutbox().length) flushOutbox();
             
             try {
-                const response = await fetch(`/api/messages?user_id=${selectedUserId}`);
-                const data = await response.json();
-                
-                if (data.success) {
-                    const messagesContainer = document.getElementById('messagesContainer');
-                    messagesContainer.innerHTML = '';
+                let query = `since_seq=${conversationSeq}`;
+                let changed = false;
+                let resetSeq = null;
+                while (true) {
+                    const response = await fetch(`/api/messages?user_id=${userId}&${query}`);
+                    const data = await response.json();
                     
-                    data.messages.forEach(msg => {
-                        const messageElement = document.createElement('div');
-                        messageElement.className = `message ${msg.is_own ? 'message-own' : 'message-other'}`;
-                        
-                        const time = new Date(msg.created_at).toLocaleTimeString();
-                        messageElement.innerHTML = `
-                            <strong>${msg.is_own ? 'Вы' : msg.sender_name}:</strong> ${msg.message_text}
-                            <div class="message-time">${time}</div>
-                        `;
-                        
-                        messagesContainer.appendChild(messageElement);
-                    });
+                    // Пока шел запрос, пользователь мог переключиться на другой чат
+                    if (!data.success || userId !== selectedUserId) return;
+                    
+                    // reset: сервер уже вычистил нужные надгробия и отдает переписку с начала
+                    if (data.reset) {
+                        messageList.setItems(data.messages);
+                        resetSeq = data.seq;
+                        changed = true;
+                    } else {
+                        changed = messageList.upsert(data.messages) || changed;
+                    }
                     
-                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    if (!data.has_more) {
+                        const seq = resetSeq !== null ? resetSeq : data.seq;
+                        changed = changed || seq !== conversationSeq;
+                        conversationSeq = seq;
+                        break;
+                    }
+                    // Следующая страница: после переписки с начала - по id, иначе по seq
+                    query = resetSeq !== null
+                        ? `after_id=${data.messages[data.messages.length - 1].id}`
+                        : `since_seq=${data.seq}`;
+                }
+                
+                if (changed) {
+                    messageCache.put(conversationKey(userId), {
+                        seq: conversationSeq,
+                        messages: messageList.items.map(({isNew, ...item}) => item)
+                    });
                 }
             } catch (error) {
                 console.error('Failed to load messages:', error);
             }
         }
         
+        async function changeMessage(url, body) {
+            try {
+                const response = await fetch(url, {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({ user_id: selectedUserId, ...body })
+                });
+                const data = await response.json();
+                if (!data.success) alert('Ошибка: ' + data.error);
+            } catch (error) {
+                alert('Ошибка соединения');
+            }
+            await loadMessages();
+        }
+        
+        function editMessage(messageId) {
+            const msg = messageList.items[messageList.indexOf(messageId)];
+            const messageText = prompt('Изменить сообщение', msg.message_text);
+            if (messageText === null || !messageText.trim() || messageText === msg.message_text) return;
+            changeMessage('/api/edit_message', { message_id: messageId, message_text: messageText.trim() });
+        }
+        
+        function deleteMessage(messageId) {
+            if (confirm('Удалить сообщение?')) changeMessage('/api/delete_message', { message_id: messageId });
+        }
+        
+        function newClientId() {
+            if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+            return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+        }
+        
+        // Очередь исходящих (outbox): сообщения сначала сохраняются в localStorage,
+        // затем уходят пачкой через /api/send_batch. client_id защищает от дублей
+        // при повторной отправке после обрыва связи.
+        function outboxKey() {
+            return `outbox:${currentUser}`;
+        }
+        
+        function loadOutbox() {
+            try {
+                return JSON.parse(localStorage.getItem(outboxKey())) || [];
+            } catch (error) {
+                return [];
+            }
+        }
+        
+        function saveOutbox(outbox) {
+            localStorage.setItem(outboxKey(), JSON.stringify(outbox));
+        }
+        
+        function queueMessage(message) {
+            const outbox = loadOutbox();
+            outbox.push({ ...message, client_id: newClientId() });
+            saveOutbox(outbox);
+        }
+        
+        let outboxFlush = null;
+        
+        function flushOutbox() {
+            // Одновременно идет только одна отправка очереди
+            if (!outboxFlush) outboxFlush = sendOutbox().finally(() => outboxFlush = null);
+            return outboxFlush;
+        }
+        
+        async function sendOutbox() {
+            while (currentUser) {
+                const batch = loadOutbox().slice(0, 100);
+                if (!batch.length) return;
+                
+                let data;
+                try {
+                    const response = await fetch('/api/send_batch', {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json'},
+                        body: JSON.stringify({ messages: batch })
+                    });
+                    data = await response.json();
+                } catch (error) {
+                    // Нет сети - сообщения остаются в очереди до следующей попытки
+                    return;
+                }
+                if (!data.success) return;
+                
+                const done = new Set(batch.map(item => item.client_id));
+                data.results.forEach(result => {
+                    if (!result.success) alert('Ошибка: ' + result.error);
+                });
+                saveOutbox(loadOutbox().filter(item => !done.has(item.client_id)));
+                loadMessages();
+            }
+        }
+        
+        window.addEventListener('online', flushOutbox);
+        
         async function sendMessage() {
             const messageText = document.getElementById('messageText').value.trim();
             if (!messageText || !selectedUserId) return;
             
+            queueMessage({ receiver_id: selectedUserId, message_text: messageText });
+            document.getElementById('messageText').value = '';
+            await flushOutbox();
+        }
+        
+        async function fileSha256(file) {
+            // crypto.subtle есть только в защищенном контексте (https, localhost)
+            if (!window.crypto || !crypto.subtle) return null;
+            const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        }
+        
+        async function sendAttachment(file) {
+            if (!file || !selectedUserId) return;
+            
             try {
-                const response = await fetch('/api/send_message', {
+                // Хеш считается параллельно с загрузкой и сверяется сервером при завершении
+                const hashing = fileSha256(file).catch(() => null);
+                let response = await fetch('/api/uploads', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ receiver_id: selectedUserId, message_text: messageText })
+                    body: JSON.stringify({ filename: file.name, size: file.size, mime_type: file.type })
                 });
+                let data = await response.json();
+                if (!data.success) throw new Error(data.error);
                 
-                const data = await response.json();
+                const uploadId = data.upload_id;
+                const chunkSize = data.chunk_size;
+                let received = data.received;
                 
-                if (data.success) {
-                    document.getElementById('messageText').value = '';
-                    loadMessages();
-                } else {
-                    alert('Ошибка: ' + data.error);
+                // Загружаем кусками; после обрыва продолжаем с позиции, которую вернул сервер
+                while (received < file.size) {
+                    try {
+                        response = await fetch(`/api/uploads/${uploadId}?offset=${received}`, {
+                            method: 'PUT',
+                            body: file.slice(received, received + chunkSize)
+                        });
+                        data = await response.json();
+                    } catch (error) {
+                        response = await fetch(`/api/uploads/${uploadId}`);
+                        data = await response.json();
+                    }
+                    if (data.received === undefined) throw new Error(data.error);
+                    received = data.received;
                 }
+                
+                const sha256 = await hashing;
+                response = await fetch(`/api/uploads/${uploadId}/complete`, {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify(sha256 ? { sha256 } : {})
+                });
+                data = await response.json();
+                if (!data.success) throw new Error(data.error);
+                
+                queueMessage({ receiver_id: selectedUserId, message_text: '', attachment_id: data.attachment.id });
+                await flushOutbox();
             } catch (error) {
-                alert('Ошибка отправки сообщения');
+                alert('Ошибка загрузки файла: ' + error.message);
+            } finally {
+                document.getElementById('attachmentInput').value = '';
             }
         }
         
@@ -986,14 +2871,9 @@ spa_html = '''
 </html>
 '''
 
-# Создаем файл шаблона
-with open('templates/index.html', 'w', encoding='utf-8') as f:
-    f.write(spa_html)
-
-# Инициализируем базу данных при запуске
-init_db()
-
 if __name__ == '__main__':
+    create_app()
+    start_background_jobs()
     port = int(os.environ.get('PORT', 5000))
     print("🚀 Web Messenger запущен!")
     print("✅ База данных инициализирована")
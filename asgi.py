@@ -0,0 +1,389 @@
+"""
+ASGI-вариант API мессенджера для большого числа одновременных соединений.
+
+Использует ту же бизнес-логику (do_* из app.py), ту же БД и ту же cookie
+сессии, что и Flask-приложение, поэтому оба режима взаимозаменяемы.
+Все обращения к SQLite выполняются в выделенном пуле потоков, event loop
+никогда не блокируется на диске. Загрузки и вложения (/api/uploads*,
+/api/attachments*) обслуживает само Flask-приложение через WSGI в
+отдельном пуле потоков: докачка, Range и превью не дублируются.
+
+Запуск:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+"""
+
+import asyncio
+import functools
+import io
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+
+import app as messenger
+
+flask_app = messenger.create_app()
+
+
+class AsyncDB:
+    """Асинхронный слой доступа к SQLite через выделенный executor"""
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('DB_THREADS', 4))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sqlite')
+
+    async def run(self, func, *args, connect=None):
+        """Выполнить func(db, *args) в пуле потоков с отдельным соединением"""
+        def call():
+            db = connect() if connect else messenger.get_db()
+            try:
+                return func(db, *args)
+            finally:
+                db.close()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class Request:
+    """Минимальный HTTP-запрос: метод, путь, параметры, тело и сессия"""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.body = body
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.session = load_session(self.headers.get('cookie', ''))
+        self.session_modified = False
+
+    def get_json(self):
+        try:
+            data = json.loads(self.body or b'{}')
+        except ValueError:
+            data = None
+        return data if isinstance(data, dict) else {}
+
+
+def _serializer():
+    return flask_app.session_interface.get_signing_serializer(flask_app)
+
+
+def load_session(cookie_header):
+    """Прочитать подписанную cookie сессии Flask"""
+    cookie = SimpleCookie()
+    try:
+        cookie.load(cookie_header)
+    except Exception:
+        return {}
+    morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return dict(_serializer().loads(morsel.value, max_age=max_age))
+    except BadSignature:
+        return {}
+
+
+def session_cookie(session):
+    """Сформировать заголовок Set-Cookie, совместимый с Flask"""
+    name = flask_app.config['SESSION_COOKIE_NAME']
+    if not session:
+        return f'{name}=; Expires=Thu, 01 Jan 1970 00:00:00 GMT; Max-Age=0; Path=/'
+    value = _serializer().dumps(session)
+    return f'{name}={value}; HttpOnly; Path=/'
+
+
+db = AsyncDB()
+
+
+def db_error_payload(e):
+    """Ответ на ошибку SQLite, как во Flask-маршрутах"""
+    if "no such table" in str(e):
+        messenger.init_db()
+        return {'success': False, 'error': 'База данных переинициализирована, попробуйте снова'}, 200
+    if messenger.is_lock_error(e):
+        return {'success': False, 'error': 'База данных занята, попробуйте позже'}, 503
+    return {'success': False, 'error': f'Ошибка базы данных: {str(e)}'}, 200
+
+
+def login_required(handler):
+    async def wrapper(request):
+        if 'user_id' not in request.session:
+            return {'success': False, 'error': 'Требуется авторизация'}, 401
+        return await handler(request)
+    return wrapper
+
+
+async def index(request):
+    return messenger.spa_html, 200
+
+
+async def api_login(request):
+    payload, status, user = await db.run(messenger.do_login, request.get_json())
+    if user:
+        request.session['user_id'] = user['id']
+        request.session['username'] = user['username']
+        request.session_modified = True
+    return payload, status
+
+
+async def api_register(request):
+    return await db.run(messenger.do_register, request.get_json())
+
+
+async def api_logout(request):
+    request.session.clear()
+    request.session_modified = True
+    return {'success': True}, 200
+
+
+async def api_check_auth(request):
+    if 'user_id' in request.session:
+        return {'success': True, 'username': request.session['username']}, 200
+    return {'success': False}, 200
+
+
+@login_required
+async def api_users(request):
+    return await db.run(messenger.do_list_users, request.session['user_id'])
+
+
+@login_required
+async def api_users_sync(request):
+    return await db.run(messenger.do_sync_users, request.session['user_id'], request.args.get('since'))
+
+
+@login_required
+async def api_messages(request):
+    user_id, other_user_id = request.session['user_id'], request.args.get('user_id')
+    return await db.run(
+        messenger.do_list_messages, user_id, other_user_id,
+        request.args.get('after_id'), request.args.get('since_seq'), request.args.get('limit'),
+        connect=lambda: messenger.get_messages_db(user_id, other_user_id)
+    )
+
+
+@login_required
+async def api_send_message(request):
+    user_id, data = request.session['user_id'], request.get_json()
+    return await db.run(
+        messenger.do_send_message, user_id, data,
+        connect=lambda: messenger.get_messages_db(user_id, data.get('receiver_id'), write=True)
+    )
+
+
+@login_required
+async def api_edit_message(request):
+    user_id, data = request.session['user_id'], request.get_json()
+    return await db.run(
+        messenger.do_edit_message, user_id, data,
+        connect=lambda: messenger.get_messages_db(user_id, data.get('user_id'), write=True)
+    )
+
+
+@login_required
+async def api_delete_message(request):
+    user_id, data = request.session['user_id'], request.get_json()
+    return await db.run(
+        messenger.do_delete_message, user_id, data,
+        connect=lambda: messenger.get_messages_db(user_id, data.get('user_id'), write=True)
+    )
+
+
+@login_required
+async def api_send_batch(request):
+    return await db.run(messenger.do_send_batch, request.session['user_id'], request.get_json())
+
+
+@login_required
+async def api_wait(request):
+    """Long polling без занятого потока: ждем событие шины в event loop"""
+    user_id = request.session['user_id']
+    cursor = request.args.get('cursor')
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    # Подписка ждет подтверждения шины, поэтому выполняется вне event loop
+    try:
+        unsubscribe = await loop.run_in_executor(None, functools.partial(
+            messenger.bus.subscribe, f'user:{user_id}', lambda event: loop.call_soon_threadsafe(woken.set)
+        ))
+    except ConnectionError:
+        return {'success': False, 'error': 'Шина уведомлений недоступна, попробуйте позже'}, 503
+    try:
+        payload, status = await db.run(messenger.do_check_incoming, user_id, cursor)
+        if cursor is not None and status == 200 and not payload['events'] and not payload['reset']:
+            try:
+                await asyncio.wait_for(woken.wait(), messenger.wait_timeout(request.args.get('timeout')))
+            except asyncio.TimeoutError:
+                return payload, status
+            payload, status = await db.run(messenger.do_check_incoming, user_id, cursor)
+    finally:
+        unsubscribe()
+    return payload, status
+
+
+routes = {
+    ('GET', '/'): index,
+    ('POST', '/api/login'): api_login,
+    ('POST', '/api/register'): api_register,
+    ('GET', '/api/logout'): api_logout,
+    ('GET', '/api/check_auth'): api_check_auth,
+    ('GET', '/api/users'): api_users,
+    ('GET', '/api/users/sync'): api_users_sync,
+    ('GET', '/api/messages'): api_messages,
+    ('POST', '/api/send_message'): api_send_message,
+    ('POST', '/api/edit_message'): api_edit_message,
+    ('POST', '/api/delete_message'): api_delete_message,
+    ('POST', '/api/send_batch'): api_send_batch,
+    ('GET', '/api/wait'): api_wait,
+}
+
+
+# Пути, которые передаются Flask-приложению целиком
+WSGI_PREFIXES = ('/api/uploads', '/api/attachments')
+
+wsgi_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('WSGI_THREADS', 4)), thread_name_prefix='wsgi'
+)
+
+
+def wsgi_environ(scope, body):
+    """WSGI-окружение для запроса ASGI с уже прочитанным телом"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def call_wsgi(scope, receive, send):
+    """Выполнить запрос Flask-приложением; тело ответа отдается по частям"""
+    environ = wsgi_environ(scope, await read_body(receive))
+    loop = asyncio.get_running_loop()
+
+    def emit(message):
+        # Ждем отправки каждой части: файл не читается быстрее, чем уходит клиенту
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def respond():
+        head = {}
+
+        def start_response(status, headers, exc_info=None):
+            head['status'] = int(status.split(' ', 1)[0])
+            head['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        response = flask_app(environ, start_response)
+        try:
+            started = False
+            for chunk in response:
+                if not started:
+                    emit({'type': 'http.response.start', **head})
+                    started = True
+                if chunk:
+                    emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                emit({'type': 'http.response.start', **head})
+            emit({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    await loop.run_in_executor(wsgi_executor, respond)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, payload, status, extra_headers=()):
+    if isinstance(payload, str):
+        body = payload.encode('utf-8')
+        content_type = b'text/html; charset=utf-8'
+    else:
+        body = json.dumps(payload).encode('utf-8')
+        content_type = b'application/json'
+    headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            messenger.start_background_jobs()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            db.shutdown()
+            wsgi_executor.shutdown(wait=True)
+            messenger.bus.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """Точка входа ASGI"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'].startswith(WSGI_PREFIXES):
+        return await call_wsgi(scope, receive, send)
+
+    handler = routes.get((scope['method'], scope['path']))
+    if handler is None:
+        return await send_response(send, {'success': False, 'error': 'Не найдено'}, 404)
+
+    request = Request(scope, await read_body(receive))
+    try:
+        payload, status = await handler(request)
+    except sqlite3.OperationalError as e:
+        payload, status = db_error_payload(e)
+    except Exception as e:
+        payload, status = {'success': False, 'error': f'Ошибка сервера: {str(e)}'}, 500
+
+    extra_headers = []
+    if request.session_modified:
+        extra_headers.append((b'set-cookie', session_cookie(request.session).encode('latin-1')))
+    await send_response(send, payload, status, extra_headers)
@@ -0,0 +1,278 @@
+"""
+Нагрузочная проверка блокировок SQLite при нескольких воркерах.
+
+Запускает несколько процессов (как воркеры gunicorn), в каждом - потоки
+с test_client приложения, которые на общей БД одновременно регистрируют
+пользователей, отправляют, правят, удаляют и читают сообщения. Отдельный
+поток-«хулиган» может периодически удерживать блокировку записи (как
+долгая миграция или ручной запрос), чтобы проверить повторы.
+
+В конце печатает задержки операций, ошибки и распределение ожидания
+блокировки записи (сумма по всем процессам), поэтому результат настройки
+(DB_BUSY_TIMEOUT, DB_RETRY_*, SHARD_COUNT) можно сравнить числами.
+Код возврата 1, если хоть один запрос завершился ошибкой занятой БД.
+
+    python chaos.py --processes 4 --threads 8 --duration 20
+    python chaos.py --locker-ms 300 --retry-attempts 1    # без повторов
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from dblocks import WAIT_BUCKETS_MS, merge_snapshots, percentile
+
+USERS = 20
+PASSWORD = 'chaos-password'
+
+# Операция и ее вес в смеси нагрузки
+OPERATIONS = (
+    ('send_message', 40),
+    ('list_messages', 25),
+    ('send_batch', 10),
+    ('edit_message', 8),
+    ('delete_message', 4),
+    ('register', 8),
+    ('login', 5),
+)
+
+
+def app_config(args):
+    return {
+        'DATABASE': os.path.join(args.directory, 'messenger.db'),
+        'ATTACHMENTS_DIR': os.path.join(args.directory, 'attachments'),
+        'SHARD_COUNT': args.shards,
+        'SHARD_PATH': os.path.join(args.directory, 'messenger-shard-{}.db'),
+        'NOTIFY_BUS': 'memory://',
+        'VACUUM_INTERVAL_HOURS': 0,
+        'ROLLUP_INTERVAL_SECONDS': args.rollup_interval,
+        'DB_BUSY_TIMEOUT': args.busy_timeout,
+        'DB_RETRY_ATTEMPTS': args.retry_attempts,
+        'STARTUP_TARGET_MS': 10000,
+    }
+
+
+def prepare(args):
+    """Схема и пользователи chaos-0..N до запуска воркеров"""
+    import app as messenger
+    messenger.create_app(app_config(args))
+    client = messenger.app.test_client()
+    for n in range(USERS):
+        client.post('/api/register', json={'username': f'chaos-{n}', 'phone': f'+7000{n:07d}',
+                                           'password': PASSWORD, 'confirm': PASSWORD})
+    db = messenger.get_db()
+    ids = [row['id'] for row in db.execute("SELECT id FROM users WHERE username LIKE 'chaos-%'")]
+    db.close()
+    return ids
+
+
+def is_locked(response, data):
+    error = str(data.get('error', ''))
+    return response.status_code == 503 or 'занята' in error or 'locked' in error
+
+
+def client_loop(messenger, worker, thread, user_ids, deadline, result):
+    rng = random.Random(worker * 1000 + thread)
+    client = messenger.app.test_client()
+    me = rng.randrange(USERS)
+    client.post('/api/login', json={'username': f'chaos-{me}', 'password': PASSWORD})
+    my_id = user_ids[me]
+    own = []
+    names, weights = zip(*OPERATIONS)
+
+    while time.time() < deadline:
+        operation = rng.choices(names, weights)[0]
+        other = rng.choice([u for u in user_ids if u != my_id])
+        started = time.perf_counter()
+        if operation == 'send_message':
+            response = client.post('/api/send_message', json={
+                'receiver_id': other, 'message_text': 'chaos', 'client_id': f'{worker}-{thread}-{started}'})
+        elif operation == 'send_batch':
+            response = client.post('/api/send_batch', json={'messages': [
+                {'receiver_id': rng.choice(user_ids), 'message_text': 'batch',
+                 'client_id': f'{worker}-{thread}-{started}-{i}'} for i in range(rng.randint(2, 20))
+            ]})
+        elif operation == 'list_messages':
+            response = client.get(f'/api/messages?user_id={other}&since_seq={rng.randint(0, 50)}')
+        elif operation in ('edit_message', 'delete_message') and own:
+            if operation == 'delete_message':
+                message_id, receiver_id = own.pop(rng.randrange(len(own)))
+            else:
+                message_id, receiver_id = rng.choice(own)
+            response = client.post(f'/api/{operation}', json={
+                'user_id': receiver_id, 'message_id': message_id, 'message_text': 'edited'})
+        elif operation == 'register':
+            name = f'chaos-{worker}-{thread}-{rng.getrandbits(48):x}'
+            response = client.post('/api/register', json={'username': name, 'phone': name,
+                                                          'password': PASSWORD, 'confirm': PASSWORD})
+        else:
+            operation = 'login'
+            response = client.post('/api/login', json={'username': f'chaos-{me}', 'password': PASSWORD})
+        elapsed = (time.perf_counter() - started) * 1000
+
+        data = response.get_json(silent=True) or {}
+        result['latency'][operation].append(elapsed)
+        if data.get('success'):
+            result['outcomes'][operation, 'ok'] += 1
+            if operation == 'send_message':
+                own.append((data['message_id'], other))
+        elif is_locked(response, data):
+            result['outcomes'][operation, 'locked'] += 1
+        else:
+            result['outcomes'][operation, 'error'] += 1
+            result['errors'][str(data.get('error', response.status_code))[:80]] += 1
+
+
+def run_worker(args, worker, user_ids, deadline, queue):
+    """Один «воркер gunicorn»: свое приложение и args.threads клиентов"""
+    import app as messenger
+    messenger.create_app(app_config(args))
+    messenger.start_background_jobs()
+    messenger.lock_stats.reset()
+
+    result = {'latency': defaultdict(list), 'outcomes': Counter(), 'errors': Counter()}
+    threads = [threading.Thread(target=client_loop, args=(messenger, worker, n, user_ids, deadline, result))
+               for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    result['lock_stats'] = messenger.lock_stats.snapshot()
+    result['latency'] = dict(result['latency'])
+    queue.put(result)
+
+
+def run_locker(paths, hold_ms, deadline):
+    """Периодически удерживать блокировку записи в случайном файле БД"""
+    rng = random.Random()
+    held = 0
+    while time.time() < deadline:
+        db = sqlite3.connect(rng.choice(paths), timeout=30, isolation_level=None)
+        db.execute("BEGIN IMMEDIATE")
+        time.sleep(rng.uniform(0, hold_ms) / 1000)
+        db.execute("COMMIT")
+        db.close()
+        held += 1
+        time.sleep(rng.uniform(0, hold_ms * 2) / 1000)
+    return held
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def report(results, elapsed, locker_held):
+    latency = defaultdict(list)
+    outcomes = Counter()
+    errors = Counter()
+    for result in results:
+        for operation, values in result['latency'].items():
+            latency[operation].extend(values)
+        outcomes.update(result['outcomes'])
+        errors.update(result['errors'])
+    locks = merge_snapshots(result['lock_stats'] for result in results)
+
+    total = sum(len(values) for values in latency.values())
+    print(f"\nЗапросов: {total} за {elapsed:.1f} с ({total / elapsed:.0f} в секунду)")
+    if locker_held:
+        print(f"Захватов блокировки «хулиганом»: {locker_held}")
+
+    print(f"\n{'операция':<16}{'всего':>8}{'ок':>8}{'занята':>8}{'ошибки':>8}"
+          f"{'p50 мс':>10}{'p90 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for operation, _ in OPERATIONS:
+        values = latency.get(operation, [])
+        if not values:
+            continue
+        print(f"{operation:<16}{len(values):>8}{outcomes[operation, 'ok']:>8}"
+              f"{outcomes[operation, 'locked']:>8}{outcomes[operation, 'error']:>8}"
+              f"{quantile(values, 0.5):>10.1f}{quantile(values, 0.9):>10.1f}"
+              f"{quantile(values, 0.99):>10.1f}{max(values):>10.1f}")
+
+    if errors:
+        print("\nОшибки (кроме занятой БД):")
+        for error, count in errors.most_common(10):
+            print(f"  {count:>6}  {error}")
+
+    print(f"\nОжидание блокировки записи: {locks['waits']} транзакций, "
+          f"p50 {percentile(locks, 0.5):.1f} мс, p90 {percentile(locks, 0.9):.1f} мс, "
+          f"p99 {percentile(locks, 0.99):.1f} мс, max {locks['max_ms']:.1f} мс")
+    print(f"Повторов: {locks['retries']} (пауз {locks['retry_sleep_ms']:.0f} мс), "
+          f"исчерпано повторов: {locks['failures']}")
+    peak = max(locks['histogram']) or 1
+    bounds = [f'<= {bound}' for bound in WAIT_BUCKETS_MS] + [f'> {WAIT_BUCKETS_MS[-1]}']
+    for bound, count in zip(bounds, locks['histogram']):
+        if count:
+            print(f"  {bound:>9} мс {count:>8}  {'#' * max(1, round(40 * count / peak))}")
+
+    return count_locked(results)
+
+
+def count_locked(results):
+    """Сколько запросов всех процессов завершилось ошибкой занятой БД"""
+    return sum(count for result in results
+               for (_, kind), count in result['outcomes'].items() if kind == 'locked')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочная проверка блокировок SQLite')
+    parser.add_argument('--processes', type=int, default=4, help='процессов-воркеров')
+    parser.add_argument('--threads', type=int, default=8, help='клиентов в каждом процессе')
+    parser.add_argument('--duration', type=float, default=10, help='длительность, с')
+    parser.add_argument('--shards', type=int, default=0, help='SHARD_COUNT')
+    parser.add_argument('--busy-timeout', type=float, default=5, help='DB_BUSY_TIMEOUT, с')
+    parser.add_argument('--retry-attempts', type=int, default=5, help='DB_RETRY_ATTEMPTS')
+    parser.add_argument('--rollup-interval', type=float, default=1, help='ROLLUP_INTERVAL_SECONDS (0 - выкл.)')
+    parser.add_argument('--locker-ms', type=float, default=0, help='держать блокировку до N мс (0 - выкл.)')
+    parser.add_argument('--directory', help='каталог для БД (по умолчанию временный)')
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Прогон нагрузки: (результаты процессов, длительность, захваты «хулигана»)"""
+    temporary = args.directory is None
+    if temporary:
+        args.directory = tempfile.mkdtemp(prefix='messenger-chaos-')
+    try:
+        user_ids = prepare(args)
+        print(f"Процессов: {args.processes}, клиентов в процессе: {args.threads}, "
+              f"шардов: {args.shards}, busy timeout: {args.busy_timeout} с, попыток: {args.retry_attempts}")
+
+        deadline = time.time() + args.duration
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker, args=(args, n, user_ids, deadline, queue))
+                   for n in range(args.processes)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+
+        locker_held = 0
+        if args.locker_ms:
+            config = app_config(args)
+            paths = [config['DATABASE']] + [config['SHARD_PATH'].format(n) for n in range(args.shards)]
+            locker_held = run_locker(paths, args.locker_ms, deadline)
+
+        results = [queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        return results, time.perf_counter() - started, locker_held
+    finally:
+        if temporary:
+            shutil.rmtree(args.directory, ignore_errors=True)
+
+
+def main():
+    locked = report(*run(parse_args()))
+    raise SystemExit(1 if locked else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Блокировки записи SQLite: замер ожидания, повторы и статистика.
+
+В файле SQLite одновременно пишет только один процесс. Все транзакции
+записи начинаются через begin_write() (BEGIN IMMEDIATE), и время
+ожидания блокировки (в том числе неудачного) попадает в гистограмму
+LockStats. Если блокировку не удалось получить за busy timeout или SQLite
+сразу вернул SQLITE_BUSY (например, при фиксации WAL-чекпоинта),
+RetryPolicy откатывает транзакцию и повторяет всю единицу работы с
+экспоненциальной паузой и случайным разбросом (full jitter), чтобы
+конкурирующие воркеры не просыпались одновременно.
+"""
+
+import random
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограммы ожидания, мс (последняя корзина - все, что дольше)
+WAIT_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+LOCK_ERRORS = ('database is locked', 'database is busy', 'database table is locked')
+
+
+def is_lock_error(error):
+    """Ошибка означает занятую БД, а не ошибку в запросе"""
+    return isinstance(error, sqlite3.OperationalError) and str(error).startswith(LOCK_ERRORS)
+
+
+class LockStats:
+    """Распределение ожидания блокировки записи и счетчики повторов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+            self.waits = 0
+            self.total_ms = 0.0
+            self.max_ms = 0.0
+            self.retries = 0
+            self.retry_sleep_ms = 0.0
+            self.failures = 0
+
+    def record_wait(self, ms):
+        with self._lock:
+            self.histogram[bisect_left(WAIT_BUCKETS_MS, ms)] += 1
+            self.waits += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def record_retry(self, delay_ms):
+        with self._lock:
+            self.retries += 1
+            self.retry_sleep_ms += delay_ms
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'waits': self.waits,
+                'total_ms': round(self.total_ms, 3),
+                'max_ms': round(self.max_ms, 3),
+                'histogram': list(self.histogram),
+                'retries': self.retries,
+                'retry_sleep_ms': round(self.retry_sleep_ms, 3),
+                'failures': self.failures
+            }
+
+
+def merge_snapshots(snapshots):
+    """Сложить снимки LockStats нескольких процессов"""
+    merged = {'waits': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'histogram': [0] * (len(WAIT_BUCKETS_MS) + 1),
+              'retries': 0, 'retry_sleep_ms': 0.0, 'failures': 0}
+    for snapshot in snapshots:
+        for key in ('waits', 'total_ms', 'retries', 'retry_sleep_ms', 'failures'):
+            merged[key] += snapshot[key]
+        merged['max_ms'] = max(merged['max_ms'], snapshot['max_ms'])
+        merged['histogram'] = [a + b for a, b in zip(merged['histogram'], snapshot['histogram'])]
+    return merged
+
+
+def percentile(snapshot, q):
+    """Оценка перцентиля ожидания по гистограмме (верхняя граница корзины), мс"""
+    if not snapshot['waits']:
+        return 0.0
+    rank = q * snapshot['waits']
+    seen = 0
+    for bound, count in zip(WAIT_BUCKETS_MS, snapshot['histogram']):
+        seen += count
+        if seen >= rank:
+            return min(bound, snapshot['max_ms'])
+    return snapshot['max_ms']
+
+
+def summary(snapshot):
+    """Краткая сводка для API: перцентили вместо сырой гистограммы"""
+    return {
+        'waits': snapshot['waits'],
+        'mean_ms': round(snapshot['total_ms'] / snapshot['waits'], 3) if snapshot['waits'] else 0.0,
+        'p50_ms': percentile(snapshot, 0.5),
+        'p90_ms': percentile(snapshot, 0.9),
+        'p99_ms': percentile(snapshot, 0.99),
+        'max_ms': snapshot['max_ms'],
+        'histogram': [{'le_ms': bound, 'count': count}
+                      for bound, count in zip(WAIT_BUCKETS_MS + (None,), snapshot['histogram'])],
+        'retries': snapshot['retries'],
+        'retry_sleep_ms': snapshot['retry_sleep_ms'],
+        'failures': snapshot['failures']
+    }
+
+
+lock_stats = LockStats()
+
+
+def begin_write(cursor, stats=lock_stats):
+    """Начать транзакцию записи, замерив ожидание блокировки (и неудачное тоже)"""
+    started = time.perf_counter()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+    finally:
+        stats.record_wait((time.perf_counter() - started) * 1000)
+
+
+class RetryPolicy:
+    """Повтор единицы работы с БД при занятой базе.
+
+    attempts - всего попыток (1 - без повторов); пауза перед повтором n
+    выбирается случайно из [0, min(max_delay_ms, base_delay_ms * 2**n)].
+    """
+
+    def __init__(self, attempts=5, base_delay_ms=20, max_delay_ms=1000, stats=lock_stats):
+        self.attempts = max(1, attempts)
+        self.base_delay_ms = base_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.stats = stats
+
+    def delay_ms(self, attempt):
+        return random.uniform(0, min(self.max_delay_ms, self.base_delay_ms * 2 ** attempt))
+
+    def run(self, func, db, *args):
+        """func(db, *args) с повторами; перед повтором транзакция db откатывается"""
+        attempt = 0
+        while True:
+            try:
+                return func(db, *args)
+            except sqlite3.OperationalError as e:
+                if not is_lock_error(e):
+                    raise
+                if db.in_transaction:
+                    db.rollback()
+                attempt += 1
+                if attempt >= self.attempts:
+                    self.stats.record_failure()
+                    raise
+                delay = self.delay_ms(attempt - 1)
+                self.stats.record_retry(delay)
+                time.sleep(delay / 1000)
@@ -0,0 +1,15 @@
+# Конфигурация gunicorn: gunicorn 'app:create_app()'
+# preload_app - приложение и миграции БД создаются один раз в мастере до fork,
+# воркеры получают готовый процесс и стартуют мгновенно
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Фоновые задачи запускаются в воркерах, а не в мастере: потоки мастера
+    # после fork не работают. Выполняет их один воркер, выбранный блокировкой
+    import app
+    app.start_background_jobs()
@@ -0,0 +1,414 @@
+"""
+Шина уведомлений о новых сообщениях между процессами и узлами.
+
+api_send_message публикует событие в канал user:<id>, а ожидающие клиенты
+(/api/wait) подписываются на канал своего пользователя. Бэкенд задается
+URL в NOTIFY_BUS:
+
+    memory://                       - внутри одного процесса (по умолчанию)
+    unix:///tmp/messenger-bus.sock  - локальный брокер на Unix-сокете
+    redis://127.0.0.1:6379          - Redis или совместимый сервер
+
+Локальный брокер говорит на подмножестве протокола Redis (RESP: SUBSCRIBE,
+UNSUBSCRIBE, PUBLISH, PING), поэтому один и тот же клиент работает с обоими,
+а брокер служит заменой Redis при тестировании:
+
+    python notify_bus.py broker --unix /tmp/messenger-bus.sock
+    python notify_bus.py broker --port 6390
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+
+class InProcessBus:
+    """Подписчики и доставка событий внутри одного процесса"""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, callback):
+        """Подписать callback(payload) на канал; возвращает функцию отписки"""
+        with self._lock:
+            first = not self._subscribers[channel]
+            self._subscribers[channel].add(callback)
+        if first:
+            self._channel_added(channel)
+        return lambda: self._unsubscribe(channel, callback)
+
+    def _unsubscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(channel)
+            if callbacks is None:
+                return
+            callbacks.discard(callback)
+            last = not callbacks
+            if last:
+                del self._subscribers[channel]
+        if last:
+            self._channel_removed(channel)
+
+    def _channel_added(self, channel):
+        pass
+
+    def _channel_removed(self, channel):
+        pass
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"❌ Ошибка обработчика уведомления: {e}")
+
+    def publish(self, channel, payload):
+        self._dispatch(channel, payload)
+
+    def close(self):
+        pass
+
+
+def encode_command(*args):
+    """Команда в формате RESP (массив bulk-строк)"""
+    out = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        out.append(f'${len(arg)}\r\n'.encode() + arg + b'\r\n')
+    return b''.join(out)
+
+
+def read_reply(stream):
+    """Прочитать один ответ RESP из файлового объекта сокета"""
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('Соединение с шиной закрыто')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        raise RuntimeError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(stream) for _ in range(length)]
+    raise RuntimeError(f'Неизвестный ответ шины: {line!r}')
+
+
+class RespBus(InProcessBus):
+    """Клиент шины по протоколу Redis: через TCP или Unix-сокет.
+
+    Публикации идут по одному соединению, подписки - по другому, которое
+    читает фоновый поток. Соединения создаются лениво и пересоздаются после
+    fork и при обрывах (с повторной подпиской на все каналы).
+
+    Публикация выполняется в запросе после фиксации сообщения, поэтому
+    подключение, отправка и ответ ограничены timeout, а после неудачи
+    публикации в течение reconnect_delay сразу отказывают, не дожидаясь
+    недоступного сервера. subscribe() возвращается только после
+    подтверждения подписки сервером: событие, опубликованное после этого,
+    гарантированно будет доставлено.
+    """
+
+    def __init__(self, address, family=socket.AF_INET, reconnect_delay=1.0, timeout=2.0):
+        super().__init__()
+        self.address = address
+        self.family = family
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        self._pub_sock = None
+        self._pub_stream = None
+        self._pub_lock = threading.Lock()
+        self._pub_retry_at = 0.0
+        self._sub_sock = None
+        # Изменение набора подписчиков канала, его событие подтверждения и
+        # отправка SUBSCRIBE/UNSUBSCRIBE выполняются под этой блокировкой
+        # целиком, иначе последняя отписка и новая подписка на тот же канал
+        # могут дойти до сервера в обратном порядке
+        self._sub_lock = threading.RLock()
+        # Канал -> событие «сервер подтвердил подписку» (сбрасывается при обрыве)
+        self._confirmed = {}
+        # Канал -> число отправленных SUBSCRIBE, на которые еще нет ответа
+        self._sub_pending = {}
+        self._reader = None
+        self._pid = None
+        self._closed = False
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        if self.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _check_fork(self):
+        # Соединения родительского процесса после fork не используем
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pub_sock = self._pub_stream = None
+            self._sub_sock = None
+            self._confirmed = {}
+            self._sub_pending = {}
+            self._reader = None
+
+    def publish(self, channel, payload):
+        data = json.dumps(payload)
+        with self._pub_lock:
+            self._check_fork()
+            if time.monotonic() < self._pub_retry_at:
+                raise ConnectionError('Шина уведомлений недоступна')
+            for attempt in range(2):
+                fresh = self._pub_sock is None
+                try:
+                    if fresh:
+                        self._pub_sock = self._connect()
+                        self._pub_stream = self._pub_sock.makefile('rb')
+                    self._pub_sock.sendall(encode_command('PUBLISH', channel, data))
+                    return read_reply(self._pub_stream)
+                except (OSError, ConnectionError):
+                    if self._pub_sock is not None:
+                        self._pub_sock.close()
+                    self._pub_sock = self._pub_stream = None
+                    # Повторяем только на новом соединении после обрыва старого
+                    if fresh or attempt:
+                        self._pub_retry_at = time.monotonic() + self.reconnect_delay
+                        raise
+
+    def subscribe(self, channel, callback):
+        """Подписать callback на канал и дождаться подтверждения сервера.
+
+        Если подтверждения нет за timeout, подписка снимается и
+        выбрасывается ConnectionError.
+        """
+        with self._sub_lock:
+            unsubscribe = super().subscribe(channel, callback)
+            confirmed = self._confirmed.setdefault(channel, threading.Event())
+        if not confirmed.wait(self.timeout):
+            unsubscribe()
+            raise ConnectionError('Шина уведомлений не подтвердила подписку')
+        return unsubscribe
+
+    def _unsubscribe(self, channel, callback):
+        with self._sub_lock:
+            super()._unsubscribe(channel, callback)
+
+    def _send_sub(self, *args):
+        command = encode_command(*args)
+        with self._sub_lock:
+            # Без соединения команду не отправляем: поток чтения при
+            # подключении сам подпишется на все текущие каналы
+            if self._sub_sock is None:
+                return
+            try:
+                # Не блокируемся в запросе: если буфер сокета полон, команда
+                # ушла бы частично, поэтому соединение пересоздается
+                if self._sub_sock.send(command, getattr(socket, 'MSG_DONTWAIT', 0)) != len(command):
+                    raise BlockingIOError
+                if args[0] == 'SUBSCRIBE':
+                    for channel in args[1:]:
+                        self._sub_pending[channel] = self._sub_pending.get(channel, 0) + 1
+            except OSError:
+                try:
+                    self._sub_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _channel_added(self, channel):
+        # Вызывается под _sub_lock; событие всегда новое: старое могло
+        # остаться установленным от предыдущей подписки на канал
+        self._confirmed[channel] = threading.Event()
+        with self._pub_lock:
+            self._check_fork()
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_loop, name='notify-bus', daemon=True)
+                self._reader.start()
+                return
+        self._send_sub('SUBSCRIBE', channel)
+
+    def _channel_removed(self, channel):
+        # Вызывается под _sub_lock
+        self._confirmed.pop(channel, None)
+        self._send_sub('UNSUBSCRIBE', channel)
+
+    def _handle_reply(self, reply):
+        if not isinstance(reply, list) or len(reply) < 2:
+            return
+        kind, channel = reply[0], reply[1].decode()
+        if kind == b'message':
+            self._dispatch(channel, json.loads(reply[2]))
+        elif kind == b'subscribe':
+            with self._sub_lock:
+                # Подписка подтверждена ответом на последний отправленный SUBSCRIBE,
+                # а не на более ранний, после которого уже была отписка
+                pending = self._sub_pending.get(channel, 0) - 1
+                if pending > 0:
+                    self._sub_pending[channel] = pending
+                    return
+                self._sub_pending.pop(channel, None)
+                confirmed = self._confirmed.get(channel)
+                if confirmed is not None:
+                    confirmed.set()
+
+    def _read_loop(self):
+        while not self._closed:
+            try:
+                sock = self._connect()
+                # Список каналов берется под _sub_lock: канал, добавленный
+                # позже, _send_sub() отправит уже в это соединение
+                with self._sub_lock:
+                    with self._lock:
+                        channels = list(self._subscribers)
+                    self._sub_sock = sock
+                    self._sub_pending = {channel: 1 for channel in channels}
+                    if channels:
+                        sock.sendall(encode_command('SUBSCRIBE', *channels))
+                # Чтение подписки блокирующее: сообщений может не быть долго
+                sock.settimeout(None)
+                stream = sock.makefile('rb')
+                while True:
+                    self._handle_reply(read_reply(stream))
+            except (OSError, ConnectionError, ValueError) as e:
+                if self._closed:
+                    return
+                print(f"⚠️ Шина уведомлений недоступна ({e}), переподключение")
+                with self._sub_lock:
+                    self._sub_sock = None
+                    self._sub_pending = {}
+                    for confirmed in self._confirmed.values():
+                        confirmed.clear()
+                time.sleep(self.reconnect_delay)
+
+    def close(self):
+        self._closed = True
+        for sock in (self._pub_sock, self._sub_sock):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                    sock.close()
+                except OSError:
+                    pass
+
+
+def create_bus(url):
+    """Бэкенд шины по URL из конфигурации"""
+    parsed = urlparse(url or 'memory://')
+    if parsed.scheme == 'memory':
+        return InProcessBus()
+    if parsed.scheme == 'unix':
+        return RespBus(parsed.path, family=socket.AF_UNIX)
+    if parsed.scheme == 'redis':
+        return RespBus((parsed.hostname or '127.0.0.1', parsed.port or 6379))
+    raise ValueError(f'Неизвестный бэкенд шины уведомлений: {url}')
+
+
+class Broker:
+    """Локальный брокер подписок, совместимый с Redis Pub/Sub"""
+
+    def __init__(self):
+        self.channels = defaultdict(set)
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = await reader.readline()
+            length = int(header[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def handle(self, reader, writer):
+        subscribed = set()
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                command = args[0].upper()
+                if command == b'PUBLISH' and len(args) == 3:
+                    receivers = list(self.channels.get(args[1], ()))
+                    message = encode_command('message', args[1], args[2])
+                    for receiver in receivers:
+                        receiver.write(message)
+                    writer.write(f':{len(receivers)}\r\n'.encode())
+                elif command == b'SUBSCRIBE':
+                    for channel in args[1:]:
+                        subscribed.add(channel)
+                        self.channels[channel].add(writer)
+                        writer.write(encode_command('subscribe', channel, len(subscribed)))
+                elif command == b'UNSUBSCRIBE':
+                    for channel in args[1:] or list(subscribed):
+                        subscribed.discard(channel)
+                        self.channels[channel].discard(writer)
+                        if not self.channels[channel]:
+                            del self.channels[channel]
+                        writer.write(encode_command('unsubscribe', channel, len(subscribed)))
+                elif command == b'PING':
+                    writer.write(b'+PONG\r\n')
+                else:
+                    writer.write(b'-ERR unknown command\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels[channel].discard(writer)
+                if not self.channels[channel]:
+                    del self.channels[channel]
+            writer.close()
+
+
+async def run_broker(unix_path=None, host='127.0.0.1', port=6390):
+    broker = Broker()
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        server = await asyncio.start_unix_server(broker.handle, path=unix_path)
+        print(f"🚀 Брокер уведомлений слушает {unix_path}")
+    else:
+        server = await asyncio.start_server(broker.handle, host=host, port=port)
+        print(f"🚀 Брокер уведомлений слушает {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Брокер шины уведомлений мессенджера')
+    parser.add_argument('command', choices=['broker'])
+    parser.add_argument('--unix', help='путь к Unix-сокету')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_broker(args.unix, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,202 @@
+"""
+Профилировщик запросов к SQLite и журнал медленных запросов.
+
+Включается только если задан порог (SLOW_QUERY_MS): тогда get_db()
+открывает соединение класса ProfiledConnection. Для каждого запроса
+учитывается время execute и последующих fetch (SQLite выполняет SELECT
+по мере чтения строк), число строк и форма параметров (типы без
+значений). Запросы дольше порога пишутся в журнал одной JSON-строкой
+вместе с EXPLAIN QUERY PLAN и остаются в кольцевом буфере для
+административного API.
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger('messenger.sql')
+
+_whitespace_re = re.compile(r'\s+')
+
+
+def params_shape(params):
+    """Типы параметров без самих значений (пароли и тексты в журнал не попадают)"""
+    if params is None:
+        return []
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+
+class QueryProfiler:
+    """Сбор медленных запросов: журнал и последние N записей в памяти"""
+
+    def __init__(self, threshold_ms, capacity=200, log_path=None):
+        self.threshold_ms = threshold_ms
+        self.recent = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        if log_path:
+            handler = logging.FileHandler(log_path, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def record(self, connection, entry):
+        params = entry.pop('_params')
+        if entry['duration_ms'] < self.threshold_ms:
+            return
+        entry['plan'] = explain(connection, entry['sql'], params)
+        with self._lock:
+            self.recent.append(entry)
+        logger.info(json.dumps(entry, ensure_ascii=False))
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.recent)
+
+
+def explain(connection, sql, params):
+    """EXPLAIN QUERY PLAN для запроса (только для SELECT/UPDATE/DELETE/INSERT)"""
+    if sql.split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT'):
+        return []
+    try:
+        cursor = sqlite3.Connection.execute(connection, 'EXPLAIN QUERY PLAN ' + sql, params or ())
+        return [row[-1] for row in cursor.fetchall()]
+    except sqlite3.Error:
+        return []
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Курсор, который замеряет execute и чтение результата.
+
+    Соединение не держит курсор: недочитанный курсор освобождается (и
+    сбрасывает свой запрос и снимок чтения) так же, как без профилировщика,
+    а запись о нем попадает в журнал из __del__.
+    """
+
+    _entry = None
+
+    def _finish(self):
+        entry, self._entry = self._entry, None
+        if entry is None:
+            return
+        if entry['rows'] == 0 and self.rowcount > 0:
+            entry['rows'] = self.rowcount
+        entry['duration_ms'] = round(entry['duration_ms'], 3)
+        self.connection._pending.discard(self)
+        self.connection.profiler.record(self.connection, entry)
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            if self._entry is not None:
+                self._entry['duration_ms'] += (time.perf_counter() - start) * 1000
+
+    def execute(self, sql, params=()):
+        self._finish()
+        self._entry = {
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'sql': _whitespace_re.sub(' ', sql).strip(),
+            'params': params_shape(params),
+            'duration_ms': 0.0,
+            'rows': 0,
+            '_params': params
+        }
+        self.connection._pending.add(self)
+        self._timed(super().execute, sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        seq_of_params = list(seq_of_params)
+        self._entry = {
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'sql': _whitespace_re.sub(' ', sql).strip(),
+            'params': params_shape(seq_of_params[0]) if seq_of_params else [],
+            'batch': len(seq_of_params),
+            'duration_ms': 0.0,
+            'rows': 0,
+            '_params': seq_of_params[0] if seq_of_params else None
+        }
+        self.connection._pending.add(self)
+        self._timed(super().executemany, sql, seq_of_params)
+        return self
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if self._entry is not None:
+            if row is None:
+                self._finish()
+            else:
+                self._entry['rows'] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = self._timed(super().fetchmany, size)
+        if self._entry is not None:
+            self._entry['rows'] += len(rows)
+            if len(rows) < size:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        if self._entry is not None:
+            self._entry['rows'] += len(rows)
+            self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого профилируются"""
+
+    profiler = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Слабые ссылки: профилировщик не должен продлевать жизнь курсоров
+        self._pending = weakref.WeakSet()
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def close(self):
+        # Недочитанные курсоры тоже попадают в журнал
+        for cursor in list(self._pending):
+            cursor._finish()
+        super().close()
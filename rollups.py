@@ -0,0 +1,187 @@
+"""
+Сводная статистика сообщений для администраторов.
+
+Вместо GROUP BY по всей таблице messages статистика хранится в сводных
+таблицах основной БД: сообщения по часам и по дням, активные (писавшие)
+пользователи за день и число сообщений в каждой переписке. Сводки
+пополняет фоновая задача: для каждого хранилища сообщений (основная БД
+или файл шарда) запоминается последний учтенный id, и за проход читаются
+только более новые сообщения. Чтение статистики - выборки по первичному
+ключу или индексу с LIMIT, их стоимость не растет вместе с историей.
+"""
+
+from collections import Counter
+
+from dblocks import begin_write
+
+ROLLUP_BATCH = 1000
+
+
+def init_rollup_schema(cursor):
+    """Сводные таблицы и отметки обработанных сообщений"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour TEXT PRIMARY KEY,
+            messages INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            messages INTEGER NOT NULL,
+            active_users INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Кто писал в этот день: по первой записи пользователя растет active_users
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_conversations (
+            low_id INTEGER NOT NULL,
+            high_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            last_message_at DATETIME,
+            PRIMARY KEY (low_id, high_id)
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stats_conversations_messages ON stats_conversations (messages)"
+    )
+    # store - 'main' для основной БД или путь к файлу шарда
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_watermarks (
+            store TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def update_rollups(db, store, messages_db, batch=ROLLUP_BATCH):
+    """Учесть в сводках следующую пачку сообщений хранилища store.
+
+    db - основная БД со сводками, messages_db - хранилище сообщений (может
+    совпадать с db). Отметка и сводки меняются одной транзакцией, поэтому
+    одновременный запуск в нескольких воркерах не учтет сообщение дважды.
+    Возвращает число учтенных сообщений.
+    """
+    cursor = db.cursor()
+    begin_write(cursor)
+    row = cursor.execute("SELECT last_id FROM stats_watermarks WHERE store = ?", (store,)).fetchone()
+    last_id = row[0] if row else 0
+    rows = messages_db.execute(
+        "SELECT id, sender_id, receiver_id, created_at FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+        (last_id, batch)
+    ).fetchall()
+    if not rows:
+        db.rollback()
+        return 0
+
+    hourly = Counter()
+    daily = Counter()
+    senders = Counter()
+    conversations = {}
+    for _, sender_id, receiver_id, created_at in rows:
+        hourly[created_at[:13] + ':00'] += 1
+        daily[created_at[:10]] += 1
+        senders[(created_at[:10], sender_id)] += 1
+        pair = (min(sender_id, receiver_id), max(sender_id, receiver_id))
+        count, last_at = conversations.get(pair, (0, created_at))
+        conversations[pair] = (count + 1, max(last_at, created_at))
+
+    cursor.executemany('''
+        INSERT INTO stats_hourly (hour, messages) VALUES (?, ?)
+        ON CONFLICT (hour) DO UPDATE SET messages = messages + excluded.messages
+    ''', hourly.items())
+
+    new_users = Counter()
+    for (day, user_id), count in senders.items():
+        cursor.execute(
+            "INSERT OR IGNORE INTO stats_daily_users (day, user_id, messages) VALUES (?, ?, 0)",
+            (day, user_id)
+        )
+        if cursor.rowcount:
+            new_users[day] += 1
+        cursor.execute(
+            "UPDATE stats_daily_users SET messages = messages + ? WHERE day = ? AND user_id = ?",
+            (count, day, user_id)
+        )
+    cursor.executemany('''
+        INSERT INTO stats_daily (day, messages, active_users) VALUES (?, ?, ?)
+        ON CONFLICT (day) DO UPDATE SET
+            messages = messages + excluded.messages,
+            active_users = active_users + excluded.active_users
+    ''', [(day, count, new_users[day]) for day, count in daily.items()])
+
+    cursor.executemany('''
+        INSERT INTO stats_conversations (low_id, high_id, messages, last_message_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (low_id, high_id) DO UPDATE SET
+            messages = messages + excluded.messages,
+            last_message_at = MAX(last_message_at, excluded.last_message_at)
+    ''', [(low, high, count, last_at) for (low, high), (count, last_at) in conversations.items()])
+
+    cursor.execute('''
+        INSERT INTO stats_watermarks (store, last_id) VALUES (?, ?)
+        ON CONFLICT (store) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+    ''', (store, rows[-1][0]))
+    db.commit()
+    return len(rows)
+
+
+def catch_up_rollups(db, store, messages_db, batch=ROLLUP_BATCH):
+    """Учесть все новые сообщения хранилища пачками по batch (каждая - своя транзакция)"""
+    total = 0
+    while True:
+        processed = update_rollups(db, store, messages_db, batch)
+        total += processed
+        if processed < batch:
+            return total
+
+
+def mark_rollups_current(db, store, messages_db):
+    """Считать все сообщения хранилища учтенными (после переноса уже учтенных
+    сообщений между шардами, чтобы не посчитать их второй раз)"""
+    last_id = messages_db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+    db.execute('''
+        INSERT INTO stats_watermarks (store, last_id) VALUES (?, ?)
+        ON CONFLICT (store) DO UPDATE SET
+            last_id = MAX(last_id, excluded.last_id), updated_at = CURRENT_TIMESTAMP
+    ''', (store, last_id))
+    db.commit()
+
+
+def read_stats(db, days=30, hours=48, top=10):
+    """Статистика за последние days дней и hours часов и top самых активных переписок"""
+    daily = db.execute(
+        "SELECT day, messages, active_users FROM stats_daily ORDER BY day DESC LIMIT ?", (days,)
+    ).fetchall()
+    hourly = db.execute(
+        "SELECT hour, messages FROM stats_hourly ORDER BY hour DESC LIMIT ?", (hours,)
+    ).fetchall()
+    conversations = db.execute('''
+        SELECT c.low_id, low.username, c.high_id, high.username, c.messages, c.last_message_at
+        FROM (SELECT * FROM stats_conversations ORDER BY messages DESC LIMIT ?) c
+        LEFT JOIN users low ON low.id = c.low_id
+        LEFT JOIN users high ON high.id = c.high_id
+        ORDER BY c.messages DESC
+    ''', (top,)).fetchall()
+    watermarks = db.execute("SELECT store, last_id, updated_at FROM stats_watermarks ORDER BY store").fetchall()
+
+    return {
+        'daily': [{'day': day, 'messages': messages, 'active_users': active_users}
+                  for day, messages, active_users in reversed(daily)],
+        'hourly': [{'hour': hour, 'messages': messages} for hour, messages in reversed(hourly)],
+        'top_conversations': [{
+            'users': [{'id': low_id, 'username': low_name}, {'id': high_id, 'username': high_name}],
+            'messages': messages,
+            'last_message_at': last_message_at
+        } for low_id, low_name, high_id, high_name, messages, last_message_at in conversations],
+        'stores': [{'store': store, 'last_id': last_id, 'updated_at': updated_at}
+                   for store, last_id, updated_at in watermarks]
+    }
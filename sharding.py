@@ -0,0 +1,318 @@
+"""
+Шардирование переписок по нескольким файлам SQLite.
+
+Переписка пары пользователей целиком живет в одном шарде, номер которого
+вычисляется хешем пары, поэтому запись в разные переписки идет в разные
+файлы параллельно. Пользователи и вложения остаются в основной БД
+(справочник), для чтения она подключается к шарду через ATTACH.
+
+В шардах id сообщений назначаются не AUTOINCREMENT, а по времени:
+(миллисекунды от MESSAGE_ID_EPOCH << 12) | (счетчик << 6) | номер шарда.
+Номер шарда занимает младшие биты, поэтому id разных шардов не совпадают
+никогда: переполнение счетчика переносится в биты времени, а не в номер
+шарда. Такие id растут в пределах переписки и при переносе между шардами
+остаются уникальными, на чем держится догрузка по after_id. Для времени
+остается 41 бит, и id безопасны для JavaScript (меньше 2**53) до 2093 года.
+
+Запись идет в шард без подключенного справочника: BEGIN IMMEDIATE
+блокирует все подключенные базы, и с ATTACH запись в любой шард занимала
+бы блокировку основной БД.
+
+Инструменты:
+    python sharding.py rebalance --from-count 0 --to-count 4
+    python sharding.py bench --counts 0 1 2 4 8
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from rollups import catch_up_rollups, mark_rollups_current
+
+MAX_SHARDS = 64
+
+# Начало отсчета времени в id сообщений: 2024-01-01 UTC, в миллисекундах
+MESSAGE_ID_EPOCH = 1704067200000
+
+
+def normalize_user_id(user_id):
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return user_id
+
+
+class ShardRouter:
+    """Выбор шарда для пары пользователей и пути к файлам шардов"""
+
+    def __init__(self, count, path_pattern='messenger-shard-{}.db'):
+        if not 0 < count <= MAX_SHARDS:
+            raise ValueError(f'Число шардов должно быть от 1 до {MAX_SHARDS}')
+        self.count = count
+        self.path_pattern = path_pattern
+
+    def shard_for(self, user_a, user_b):
+        """Номер шарда переписки; не зависит от порядка участников"""
+        low, high = sorted(str(normalize_user_id(u)) for u in (user_a, user_b))
+        digest = hashlib.sha1(f'{low}:{high}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count
+
+    def path(self, shard):
+        return self.path_pattern.format(shard)
+
+    def paths(self):
+        return [self.path(shard) for shard in range(self.count)]
+
+
+def next_message_id(cursor, shard):
+    """Следующий id сообщения в шарде; вызывать внутри BEGIN IMMEDIATE.
+
+    Младшие 6 бит - номер шарда. Если id текущей миллисекунды уже занят,
+    берется следующий id с тем же номером шарда. В шардах с id, выданными
+    до введения MESSAGE_ID_EPOCH, так продолжается счет от максимального id.
+    """
+    candidate = ((int(time.time() * 1000) - MESSAGE_ID_EPOCH) << 12) | shard
+    last = cursor.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+    if candidate > last:
+        return candidate
+    return (((last >> 6) + 1) << 6) | shard
+
+
+def open_shard(path):
+    db = sqlite3.connect(path, timeout=30)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def rebalance(database, path_pattern, from_count, to_count, init_schema, batch=500):
+    """Перенести переписки, чей шард изменился при смене числа шардов.
+
+    from_count=0 означает перенос из таблицы messages основной БД.
+    Строки копируются с сохранением id, затем удаляются из источника;
+    каждая переписка переносится одной транзакцией в целевом шарде.
+    Строка, уже лежащая в целевом шарде без изменений (повторный запуск
+    после сбоя), пропускается; другая строка с тем же id или client_id
+    останавливает перенос с RuntimeError. Из источника переписка
+    удаляется только после того, как в целевом шарде найдены все ее
+    сообщения и ревизии.
+    Сводная статистика перед переносом догоняется по всем хранилищам, а
+    после него перенесенные сообщения считаются уже учтенными.
+    Запускать при остановленном приложении.
+    """
+    target = ShardRouter(to_count, path_pattern)
+    sources = [database] if from_count == 0 else ShardRouter(from_count, path_pattern).paths()
+
+    for path in target.paths():
+        db = open_shard(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        init_schema(db)
+        db.close()
+
+    main_db = open_shard(database)
+    stores = {path: path for path in sources + target.paths() if os.path.exists(path)}
+    if from_count == 0:
+        stores[database] = 'main'
+    for path, store in stores.items():
+        messages_db = open_shard(path)
+        catch_up_rollups(main_db, store, messages_db)
+        messages_db.close()
+
+    moved = 0
+    for source_path in sources:
+        if not os.path.exists(source_path):
+            continue
+        source = open_shard(source_path)
+        pairs = source.execute('''
+            SELECT DISTINCT MIN(sender_id, receiver_id) AS low, MAX(sender_id, receiver_id) AS high
+            FROM messages
+        ''').fetchall()
+
+        for pair in pairs:
+            target_path = target.path(target.shard_for(pair['low'], pair['high']))
+            if os.path.abspath(target_path) == os.path.abspath(source_path):
+                continue
+
+            where = '''((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))'''
+            args = (pair['low'], pair['high'], pair['high'], pair['low'])
+            cursor = source.execute(f"SELECT * FROM messages WHERE {where} ORDER BY id", args)
+            columns = [d[0] for d in cursor.description]
+
+            destination = open_shard(target_path)
+            destination.execute("BEGIN IMMEDIATE")
+            insert = f"INSERT INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    try:
+                        destination.execute(insert, tuple(row))
+                    except sqlite3.IntegrityError as e:
+                        existing = destination.execute("SELECT * FROM messages WHERE id = ?", (row['id'],)).fetchone()
+                        if existing is None or tuple(existing) != tuple(row):
+                            destination.rollback()
+                            destination.close()
+                            raise RuntimeError(
+                                f"Сообщение {row['id']} из {source_path} конфликтует "
+                                f"с другой строкой в {target_path}: {e}"
+                            ) from e
+                        continue
+                    moved += 1
+
+            # Счетчик изменений и ревизии переезжают вместе с перепиской,
+            # иначе seq в новом шарде начался бы заново
+            counter = source.execute(
+                "SELECT seq, min_seq FROM conversation_seq WHERE low_id = ? AND high_id = ?",
+                (pair['low'], pair['high'])
+            ).fetchone()
+            if counter is not None:
+                destination.execute('''
+                    INSERT INTO conversation_seq (low_id, high_id, seq, min_seq) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (low_id, high_id) DO UPDATE
+                    SET seq = MAX(seq, excluded.seq), min_seq = MAX(min_seq, excluded.min_seq)
+                ''', (pair['low'], pair['high'], counter['seq'], counter['min_seq']))
+            revisions = f"message_id IN (SELECT id FROM messages WHERE {where})"
+            destination.executemany('''
+                INSERT INTO message_revisions (message_id, revision, message_text, created_at)
+                SELECT ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM message_revisions WHERE message_id = ? AND revision = ?)
+            ''', [(*row, row['message_id'], row['revision']) for row in source.execute(
+                f"SELECT message_id, revision, message_text, created_at FROM message_revisions WHERE {revisions}",
+                args
+            )])
+            destination.commit()
+
+            missing = _count_missing(destination, source_path, where, args)
+            destination.close()
+            if missing:
+                raise RuntimeError(
+                    f"В {target_path} не хватает строк переписки {pair['low']}-{pair['high']} "
+                    f"(сообщений: {missing[0]}, ревизий: {missing[1]}); {source_path} не изменен"
+                )
+
+            source.execute(f"DELETE FROM message_revisions WHERE {revisions}", args)
+            source.execute(f"DELETE FROM messages WHERE {where}", args)
+            source.execute(
+                "DELETE FROM conversation_seq WHERE low_id = ? AND high_id = ?", (pair['low'], pair['high'])
+            )
+            source.commit()
+        source.close()
+
+    for path in target.paths():
+        messages_db = open_shard(path)
+        mark_rollups_current(main_db, path, messages_db)
+        messages_db.close()
+    main_db.close()
+
+    return moved
+
+
+def _count_missing(destination, source_path, where, args):
+    """Сколько сообщений и ревизий переписки из источника нет в destination"""
+    destination.execute("ATTACH DATABASE ? AS source", (source_path,))
+    try:
+        where = where.replace('sender_id', 's.sender_id').replace('receiver_id', 's.receiver_id')
+        messages = destination.execute(f'''
+            SELECT COUNT(*) FROM source.messages AS s
+            WHERE {where} AND NOT EXISTS (SELECT 1 FROM main.messages AS d WHERE d.id = s.id)
+        ''', args).fetchone()[0]
+        revisions = destination.execute(f'''
+            SELECT COUNT(*) FROM source.message_revisions AS r
+            JOIN source.messages AS s ON s.id = r.message_id
+            WHERE {where} AND NOT EXISTS (
+                SELECT 1 FROM main.message_revisions AS d
+                WHERE d.message_id = r.message_id AND d.revision = r.revision
+            )
+        ''', args).fetchone()[0]
+    finally:
+        destination.execute("DETACH DATABASE source")
+    return (messages, revisions) if messages or revisions else None
+
+
+def _bench_writer(args):
+    """Писатель бенчмарка: отправка через get_messages_db и do_send_message,
+    как в обработчике /api/send_message"""
+    config, users, messages, seed = args
+    import app as messenger
+    messenger.create_app(config)
+    rng = random.Random(seed)
+    for _ in range(messages):
+        sender, receiver = rng.sample(range(1, users + 1), 2)
+        with messenger.app.app_context():
+            db = messenger.get_messages_db(sender, receiver, write=True)
+            try:
+                payload, status = messenger.do_send_message(
+                    db, sender, {'receiver_id': receiver, 'message_text': 'x' * 100}
+                )
+            finally:
+                db.close()
+        if status != 200:
+            raise RuntimeError(payload['error'])
+
+
+def bench(counts, writers, messages, users=1000):
+    """Пропускная способность записи (сообщений/с) для разного числа шардов.
+
+    count=0 - без шардирования, все сообщения в основной БД.
+    """
+    results = {}
+    for count in counts:
+        directory = tempfile.mkdtemp(prefix='messenger-bench-')
+        try:
+            config = {
+                'DATABASE': os.path.join(directory, 'messenger.db'),
+                'SHARD_COUNT': count,
+                'SHARD_PATH': os.path.join(directory, 'shard-{}.db'),
+                'ATTACHMENTS_DIR': os.path.join(directory, 'attachments'),
+                'VACUUM_INTERVAL_HOURS': 0,
+                'ROLLUP_INTERVAL_SECONDS': 0,
+            }
+            # Схема создается один раз до старта писателей
+            import app as messenger
+            messenger.create_app(config)
+
+            jobs = [(config, users, messages, seed) for seed in range(writers)]
+            with multiprocessing.Pool(writers) as pool:
+                started = time.perf_counter()
+                pool.map(_bench_writer, jobs)
+                elapsed = time.perf_counter() - started
+            results[count] = writers * messages / elapsed
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def _init_shard_schema(db):
+    from app import SCHEMA_VERSION, init_messages_schema, migrate
+    migrate(db, SCHEMA_VERSION, init_messages_schema)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Шардирование сообщений мессенджера')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebalance_parser = subparsers.add_parser('rebalance', help='перераспределить переписки по шардам')
+    rebalance_parser.add_argument('--database', default='messenger.db')
+    rebalance_parser.add_argument('--pattern', default='messenger-shard-{}.db')
+    rebalance_parser.add_argument('--from-count', type=int, required=True, help='0 - из основной БД')
+    rebalance_parser.add_argument('--to-count', type=int, required=True)
+
+    bench_parser = subparsers.add_parser('bench', help='замерить скорость записи')
+    bench_parser.add_argument('--counts', type=int, nargs='+', default=[0, 1, 2, 4, 8], help='0 - без шардирования')
+    bench_parser.add_argument('--writers', type=int, default=os.cpu_count())
+    bench_parser.add_argument('--messages', type=int, default=500)
+
+    args = parser.parse_args()
+    if args.command == 'rebalance':
+        moved = rebalance(args.database, args.pattern, args.from_count, args.to_count, _init_shard_schema)
+        print(f"✅ Перенесено сообщений: {moved}")
+    else:
+        print(f"Писателей: {args.writers}, сообщений на писателя: {args.messages}")
+        for count, rate in bench(args.counts, args.writers, args.messages).items():
+            print(f"  шардов: {count:3d}  -> {rate:10.0f} сообщений/с")
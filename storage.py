@@ -0,0 +1,124 @@
+"""
+Контентно-адресуемое хранилище вложений.
+
+Файлы лежат в <root>/objects/<первые 2 символа sha256>/<sha256>, поэтому
+одинаковые файлы хранятся один раз. Незавершенные загрузки копятся в
+<root>/uploads/<upload_id>.part и дописываются кусками, пока клиент не
+вызовет завершение. Запись куска и завершение берут блокировку файла
+загрузки (flock), поэтому параллельные запросы разных воркеров к одной
+загрузке не перемешивают данные.
+"""
+
+import fcntl
+import hashlib
+import os
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_upload_id_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ContentStore:
+    """Хранилище файлов по sha256 с поддержкой докачки"""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.uploads_dir = os.path.join(root, 'uploads')
+
+    def ensure_dirs(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def part_path(self, upload_id):
+        if not _upload_id_re.match(upload_id):
+            raise ValueError('Некорректный идентификатор загрузки')
+        return os.path.join(self.uploads_dir, upload_id + '.part')
+
+    def part_size(self, upload_id):
+        """Сколько байт загрузки уже получено"""
+        try:
+            return os.path.getsize(self.part_path(upload_id))
+        except FileNotFoundError:
+            return 0
+
+    def upload_mtime(self, upload_id):
+        """Время последней записи в загрузку (0, если файла нет)"""
+        try:
+            return os.path.getmtime(self.part_path(upload_id))
+        except FileNotFoundError:
+            return 0
+
+    def upload_ids(self):
+        """Идентификаторы загрузок, для которых есть файл .part"""
+        try:
+            names = os.listdir(self.uploads_dir)
+        except FileNotFoundError:
+            return []
+        return [name[:-5] for name in names if name.endswith('.part') and _upload_id_re.match(name[:-5])]
+
+    def append_chunk(self, upload_id, stream, offset, limit):
+        """Дописать с позиции offset не более limit байт из потока, не держа их в памяти.
+
+        Смещение проверяется под блокировкой файла: из двух кусков с одним
+        offset (например, запрос, отвалившийся по таймауту, и повтор клиента)
+        запишется только первый. Возвращает (записан ли кусок, размер загрузки).
+        """
+        self.ensure_dirs()
+        with open(self.part_path(upload_id), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            size = os.fstat(f.fileno()).st_size
+            if size != offset:
+                return False, size
+            written = 0
+            while written < limit:
+                data = stream.read(min(CHUNK_SIZE, limit - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+            f.flush()
+            return True, size + written
+
+    def commit(self, upload_id, expected_sha256=None):
+        """Перенести завершенную загрузку в хранилище, вернуть (sha256, размер).
+
+        Если клиент передал expected_sha256 и содержимое с ним не совпало,
+        загрузка удаляется (ее можно начать заново) и выбрасывается ValueError.
+        """
+        part = self.part_path(upload_id)
+        digest = hashlib.sha256()
+        size = 0
+        with open(part, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                size += len(data)
+
+            sha256 = digest.hexdigest()
+            if expected_sha256 is not None and sha256 != expected_sha256:
+                os.remove(part)
+                raise ValueError('Контрольная сумма файла не совпадает')
+
+            target = self.object_path(sha256)
+            if os.path.exists(target):
+                # Такой файл уже есть - дубликат не сохраняем
+                os.remove(part)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(part, target)
+        return sha256, size
+
+    def discard(self, upload_id):
+        """Удалить незавершенную загрузку"""
+        try:
+            os.remove(self.part_path(upload_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,120 @@
+"""
+Общие фикстуры тестов API.
+
+Каждый тест API выполняется против Flask-приложения (app.test_client())
+и ASGI-приложения (asgi.application), с основной БД и с тремя шардами.
+Клиенты обоих видов возвращают (статус, JSON) и хранят cookie сессии;
+request() возвращает (статус, заголовки, тело) для ответов не в JSON.
+"""
+
+import asyncio
+import json
+from urllib.parse import urlencode
+
+import pytest
+
+import app as messenger
+
+SHARD_COUNTS = [0, 3]
+
+
+def make_config(directory, shard_count=0):
+    return {
+        'DATABASE': str(directory / 'messenger.db'),
+        'ATTACHMENTS_DIR': str(directory / 'attachments'),
+        'SHARD_COUNT': shard_count,
+        'SHARD_PATH': str(directory / 'messenger-shard-{}.db'),
+        'NOTIFY_BUS': 'memory://',
+        'VACUUM_INTERVAL_HOURS': 0,
+        'ROLLUP_INTERVAL_SECONDS': 0,
+        'UPLOAD_TTL_HOURS': 0,
+    }
+
+
+class FlaskClient:
+    """Клиент Flask-приложения"""
+
+    def __init__(self):
+        self.client = messenger.app.test_client()
+
+    def request(self, method, path, params=None, body=b'', headers=None):
+        response = self.client.open(path, method=method, query_string=params, data=body, headers=headers)
+        return response.status_code, {k.lower(): v for k, v in response.headers.items()}, response.get_data()
+
+    def get(self, path, **params):
+        response = self.client.get(path, query_string=params)
+        return response.status_code, response.get_json()
+
+    def post(self, path, data):
+        response = self.client.post(path, json=data)
+        return response.status_code, response.get_json()
+
+
+class AsgiClient:
+    """Клиент ASGI-приложения: вызывает asgi.application напрямую"""
+
+    def __init__(self):
+        import asgi
+        self.application = asgi.application
+        self.cookie = None
+
+    def request(self, method, path, params=None, body=b'', headers=None):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': urlencode(params or {}).encode(),
+            'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        }
+        if self.cookie:
+            scope['headers'].append((b'cookie', self.cookie.encode()))
+        asyncio.run(self.application(scope, receive, send))
+
+        start = messages[0]
+        response_headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+        if 'set-cookie' in response_headers:
+            self.cookie = response_headers['set-cookie'].split(';')[0]
+        return start['status'], response_headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+    def get(self, path, **params):
+        status, headers, body = self.request('GET', path, params)
+        return status, json.loads(body)
+
+    def post(self, path, data):
+        status, headers, body = self.request(
+            'POST', path, body=json.dumps(data).encode(), headers={'Content-Type': 'application/json'}
+        )
+        return status, json.loads(body)
+
+
+@pytest.fixture(params=SHARD_COUNTS, ids=['single', 'shards'])
+def configured(request, tmp_path):
+    """Приложение с чистой БД во временном каталоге"""
+    messenger.create_app(make_config(tmp_path, request.param))
+    # asgi при импорте вызывает create_app() и берет уже заданную конфигурацию
+    import asgi  # noqa: F401
+    yield messenger
+    messenger.bus.close()
+
+
+@pytest.fixture(params=['flask', 'asgi'])
+def make_client(request, configured):
+    """Фабрика клиентов: make_client('alex') - клиент с выполненным входом"""
+    client_class = FlaskClient if request.param == 'flask' else AsgiClient
+
+    def make(username=None, password='password123'):
+        client = client_class()
+        if username is not None:
+            status, data = client.post('/api/login', {'username': username, 'password': password})
+            assert status == 200 and data['success'], data
+        return client
+
+    return make
@@ -0,0 +1,247 @@
+"""Одни и те же сценарии API для Flask и ASGI, с основной БД и с шардами"""
+
+import threading
+import time
+
+import pytest
+
+import app as messenger
+
+ALEX, MARIA, IVAN = 1, 2, 3
+
+
+def send(client, receiver_id, text, **extra):
+    status, data = client.post('/api/send_message', {'receiver_id': receiver_id, 'message_text': text, **extra})
+    assert status == 200 and data['success'], data
+    return data
+
+
+def conversation(client, user_id, **params):
+    status, data = client.get('/api/messages', user_id=user_id, **params)
+    assert status == 200 and data['success'], data
+    return data
+
+
+def test_requires_login(make_client):
+    client = make_client()
+    assert client.get('/api/users')[0] == 401
+    assert client.post('/api/send_message', {'receiver_id': MARIA, 'message_text': 'x'})[0] == 401
+    assert client.get('/api/check_auth')[1] == {'success': False}
+
+
+def test_login_and_check_auth(make_client):
+    client = make_client()
+    status, data = client.post('/api/login', {'username': 'alex', 'password': 'wrong'})
+    assert not data['success']
+    client = make_client('alex')
+    assert client.get('/api/check_auth')[1] == {'success': True, 'username': 'alex'}
+
+
+def test_send_and_list(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    first = send(alex, MARIA, 'привет')['message_id']
+    second = send(maria, ALEX, 'здравствуй')['message_id']
+    send(alex, IVAN, 'другая переписка')
+
+    data = conversation(maria, ALEX)
+    assert [(m['id'], m['message_text'], m['is_own']) for m in data['messages']] == [
+        (first, 'привет', False), (second, 'здравствуй', True)
+    ]
+    assert data['has_more'] is False
+    assert conversation(alex, MARIA, after_id=first)['messages'][0]['id'] == second
+    assert conversation(alex, MARIA, after_id=second)['messages'] == []
+
+
+def test_paging_by_limit(make_client):
+    alex = make_client('alex')
+    ids = [send(alex, MARIA, f'm{n}')['message_id'] for n in range(7)]
+
+    seen, after_id = [], 0
+    while True:
+        data = conversation(alex, MARIA, after_id=after_id, limit=3)
+        seen += [m['id'] for m in data['messages']]
+        if not data['has_more']:
+            break
+        after_id = seen[-1]
+    assert seen == ids
+    assert alex.get('/api/messages', user_id=MARIA, limit='x')[0] == 400
+
+
+def test_rejects_bad_input(make_client):
+    alex = make_client('alex')
+    assert alex.post('/api/send_message', [1, 2])[0] == 400
+    assert alex.post('/api/send_message', {'receiver_id': MARIA, 'message_text': 5})[0] == 400
+    assert alex.post('/api/send_message', {'receiver_id': 'x', 'message_text': 'x'})[0] == 400
+    assert alex.post('/api/send_message', {'receiver_id': MARIA, 'message_text': 'x', 'attachment_id': '1'})[0] == 400
+    assert alex.get('/api/messages')[0] == 400
+
+
+def test_client_id_deduplicates(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    first = send(alex, MARIA, 'один раз', client_id='c-1')
+    repeat = send(alex, MARIA, 'один раз', client_id='c-1')
+    assert repeat['duplicate'] is True
+    assert repeat['message_id'] == first['message_id']
+    # Тот же client_id другого отправителя - другое сообщение
+    assert not send(maria, ALEX, 'ответ', client_id='c-1').get('duplicate')
+    assert len(conversation(alex, MARIA)['messages']) == 2
+
+
+def test_batch(make_client):
+    alex = make_client('alex')
+    status, data = alex.post('/api/send_batch', {'messages': [
+        {'receiver_id': MARIA, 'message_text': 'a', 'client_id': 'b-1'},
+        {'receiver_id': IVAN, 'message_text': 'b', 'client_id': 'b-2'},
+        {'receiver_id': MARIA, 'message_text': ''},
+        {'receiver_id': MARIA, 'message_text': 'c', 'attachment_id': 999},
+    ]})
+    assert status == 200
+    assert [r['success'] for r in data['results']] == [True, True, False, False]
+
+    status, again = alex.post('/api/send_batch', {'messages': [
+        {'receiver_id': MARIA, 'message_text': 'a', 'client_id': 'b-1'},
+        {'receiver_id': IVAN, 'message_text': 'b', 'client_id': 'b-2'},
+    ]})
+    assert [(r['message_id'], r['duplicate']) for r in again['results']] == [
+        (r['message_id'], True) for r in data['results'][:2]
+    ]
+    assert [m['message_text'] for m in conversation(alex, MARIA)['messages']] == ['a']
+    assert [m['message_text'] for m in conversation(alex, IVAN)['messages']] == ['b']
+    assert alex.post('/api/send_batch', {'messages': []})[0] == 400
+
+
+def test_seq_sync_sees_edits_and_deletes(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    first = send(alex, MARIA, 'черновик')['message_id']
+    second = send(alex, MARIA, 'лишнее')['message_id']
+    synced = conversation(maria, ALEX)['seq']
+
+    status, data = alex.post('/api/edit_message', {'message_id': first, 'user_id': MARIA, 'message_text': 'итог'})
+    assert status == 200 and data['success'], data
+    status, data = alex.post('/api/delete_message', {'message_id': second, 'user_id': MARIA})
+    assert status == 200 and data['success'], data
+    # Чужое сообщение править нельзя
+    assert not maria.post('/api/edit_message', {'message_id': first, 'user_id': ALEX, 'message_text': 'x'})[1]['success']
+
+    changes = conversation(maria, ALEX, since_seq=synced)
+    assert changes['reset'] is False
+    assert [(m['id'], m['message_text'], m['revision'], m['deleted']) for m in changes['messages']] == [
+        (first, 'итог', 1, False), (second, '', 1, True)
+    ]
+    assert conversation(maria, ALEX, since_seq=changes['seq'])['messages'] == []
+    # Обычная выдача надгробия не показывает
+    assert [m['id'] for m in conversation(maria, ALEX)['messages']] == [first]
+
+
+def test_vacuum_resets_stale_sync(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    kept = send(alex, MARIA, 'остается')['message_id']
+    gone = send(alex, MARIA, 'удалим')['message_id']
+    stale = conversation(maria, ALEX)['seq']
+    assert alex.post('/api/delete_message', {'message_id': gone, 'user_id': MARIA})[1]['success']
+
+    # Надгробие старше срока хранения вычищается, min_seq поднимается
+    with messenger.app.app_context():
+        db = messenger.get_messages_db(ALEX, MARIA, write=True)
+    try:
+        db.execute(
+            "UPDATE messages SET edited_at = datetime('now', ?) WHERE id = ?",
+            (f"-{messenger.app.config['MESSAGE_RETENTION_DAYS'] + 1} days", gone)
+        )
+        db.commit()
+        min_seq = db.execute("SELECT min_seq FROM conversation_seq").fetchone()[0]
+        messenger.run_vacuum()
+        assert db.execute("SELECT min_seq FROM conversation_seq").fetchone()[0] > min_seq
+        assert db.execute("SELECT COUNT(*) FROM messages WHERE id = ?", (gone,)).fetchone()[0] == 0
+    finally:
+        db.close()
+
+    # Клиент, синхронизированный до удаления, получает переписку целиком
+    data = conversation(maria, ALEX, since_seq=stale)
+    assert data['reset'] is True
+    assert [m['id'] for m in data['messages']] == [kept]
+    assert conversation(maria, ALEX, since_seq=data['seq'])['reset'] is False
+
+
+def test_user_sync(make_client):
+    alex = make_client('alex')
+    status, full = alex.get('/api/users/sync')
+    assert status == 200 and full['full'] is True
+    assert sorted(u['username'] for u in full['upserts']) == ['ivan', 'maria']
+
+    status, data = make_client().post('/api/register', {
+        'username': 'olga', 'phone': '+79990000000', 'password': 'secret', 'confirm': 'secret'
+    })
+    assert data['success'], data
+
+    status, delta = alex.get('/api/users/sync', since=full['version'])
+    assert delta['full'] is False
+    assert [u['username'] for u in delta['upserts']] == ['olga']
+    assert delta['version'] > full['version']
+    assert alex.get('/api/users/sync', since=delta['version'])[1]['upserts'] == []
+    assert alex.get('/api/users/sync', since='x')[0] == 400
+
+
+def test_wait_returns_new_incoming(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    cursor = maria.get('/api/wait')[1]['cursor']
+    message_id = send(alex, MARIA, 'ты тут?')['message_id']
+
+    status, data = maria.get('/api/wait', cursor=cursor, timeout=1)
+    assert status == 200
+    assert [e['message_id'] for e in data['events']] == [message_id]
+    assert maria.get('/api/wait', cursor=data['cursor'], timeout=0)[1]['events'] == []
+    assert maria.get('/api/wait', cursor='x')[0] == 400
+
+
+def test_wait_sees_late_commit_in_other_shard(make_client):
+    if messenger.router is None:
+        pytest.skip('порядок фиксации расходится с порядком id только между шардами')
+    alex, maria = make_client('alex'), make_client('maria')
+    cursor = maria.get('/api/wait')[1]['cursor']
+    first = send(alex, MARIA, 'раньше')['message_id']
+    seen = maria.get('/api/wait', cursor=cursor, timeout=0)[1]
+    assert [e['message_id'] for e in seen['events']] == [first]
+
+    # Запись ivan получила меньший id, но зафиксирована в своем шарде позже
+    shard = messenger.router.shard_for(IVAN, MARIA)
+    late_id = (((first >> 6) - 1) << 6) | shard
+    with messenger.app.app_context():
+        db = messenger.get_messages_db(IVAN, MARIA, write=True)
+    try:
+        db.execute(
+            "INSERT INTO messages (id, sender_id, receiver_id, message_text) VALUES (?, ?, ?, ?)",
+            (late_id, IVAN, MARIA, 'позже')
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    data = maria.get('/api/wait', cursor=seen['cursor'], timeout=0)[1]
+    assert [e['message_id'] for e in data['events']] == [late_id]
+
+
+def test_wait_resets_cursor_of_other_layout(make_client):
+    maria = make_client('maria')
+    stores = messenger.router.count if messenger.router is not None else 1
+    data = maria.get('/api/wait', cursor=','.join(['0'] * (stores + 1)), timeout=5)[1]
+    assert data['reset'] is True and data['events'] == []
+    assert len(data['cursor'].split(',')) == stores
+
+
+def test_wait_wakes_on_new_message(make_client):
+    alex, maria = make_client('alex'), make_client('maria')
+    cursor = maria.get('/api/wait')[1]['cursor']
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(maria.get('/api/wait', cursor=cursor, timeout=5)))
+    waiter.start()
+    time.sleep(0.3)
+    started = time.perf_counter()
+    message_id = send(alex, MARIA, 'проснись')['message_id']
+    waiter.join(5)
+
+    status, data = result[0]
+    assert status == 200
+    assert [e['message_id'] for e in data['events']] == [message_id]
+    # Ответ пришел по событию шины, а не по истечении timeout
+    assert time.perf_counter() - started < 2
@@ -0,0 +1,119 @@
+"""Вложения: докачиваемая загрузка кусками и отдача файла, во Flask и в ASGI"""
+
+import hashlib
+
+ALEX, MARIA, IVAN = 1, 2, 3
+
+DATA = bytes(range(256)) * 40
+
+
+def create_upload(client, data=DATA, filename='notes.txt', mime_type='text/plain'):
+    status, created = client.post('/api/uploads', {'filename': filename, 'mime_type': mime_type, 'size': len(data)})
+    assert status == 200 and created['success'], created
+    return created['upload_id']
+
+
+def put_chunk(client, upload_id, offset, chunk):
+    status, headers, body = client.request('PUT', f'/api/uploads/{upload_id}', {'offset': offset}, chunk)
+    return status, body
+
+
+def upload(client, data=DATA, chunk_size=4096, **fields):
+    upload_id = create_upload(client, data, **fields)
+    for offset in range(0, len(data), chunk_size):
+        status, body = put_chunk(client, upload_id, offset, data[offset:offset + chunk_size])
+        assert status == 200, body
+    status, done = client.post(f'/api/uploads/{upload_id}/complete', {'sha256': hashlib.sha256(data).hexdigest()})
+    assert status == 200 and done['success'], done
+    return done['attachment']
+
+
+def share(client, attachment, receiver_id=MARIA):
+    status, data = client.post('/api/send_message', {
+        'receiver_id': receiver_id, 'message_text': 'файл', 'attachment_id': attachment['id']
+    })
+    assert status == 200 and data['success'], data
+
+
+def test_chunked_upload_reaches_conversation(make_client):
+    alex, maria, ivan = make_client('alex'), make_client('maria'), make_client('ivan')
+    attachment = upload(alex)
+    assert attachment['size'] == len(DATA)
+    share(alex, attachment)
+
+    status, headers, body = maria.request('GET', attachment['url'])
+    assert status == 200
+    assert body == DATA
+    # Участник другой переписки вложение не видит
+    assert ivan.request('GET', attachment['url'])[0] == 404
+
+
+def test_duplicate_offset_and_resume(make_client):
+    alex = make_client('alex')
+    upload_id = create_upload(alex)
+    assert put_chunk(alex, upload_id, 0, DATA[:4096])[0] == 200
+    # Повтор того же куска не дописывается второй раз
+    status, body = put_chunk(alex, upload_id, 0, DATA[:4096])
+    assert status == 409
+
+    status, progress = alex.get(f'/api/uploads/{upload_id}')
+    assert (progress['received'], progress['size']) == (4096, len(DATA))
+    status, body = put_chunk(alex, upload_id, progress['received'], DATA[progress['received']:])
+    assert status == 200
+
+    status, done = alex.post(f'/api/uploads/{upload_id}/complete', {})
+    assert status == 200 and done['success'], done
+
+
+def test_sha256_mismatch_restarts_upload(make_client):
+    alex = make_client('alex')
+    upload_id = create_upload(alex)
+    assert put_chunk(alex, upload_id, 0, DATA)[0] == 200
+
+    status, data = alex.post(f'/api/uploads/{upload_id}/complete', {'sha256': '0' * 64})
+    assert status == 422 and data['received'] == 0
+    assert alex.get(f'/api/uploads/{upload_id}')[1]['received'] == 0
+
+
+def test_concurrent_complete(make_client, monkeypatch):
+    alex = make_client('alex')
+    upload_id = create_upload(alex)
+    assert put_chunk(alex, upload_id, 0, DATA)[0] == 200
+
+    import app as messenger
+    commit = messenger.store.commit
+
+    def racing_commit(upload_id, expected_sha256=None):
+        # Параллельный запрос завершает ту же загрузку первым
+        commit(upload_id, expected_sha256)
+        return commit(upload_id, expected_sha256)
+
+    monkeypatch.setattr(messenger.store, 'commit', racing_commit)
+    assert alex.post(f'/api/uploads/{upload_id}/complete', {})[0] == 409
+
+
+def test_create_rejects_bad_input(make_client):
+    alex = make_client('alex')
+    assert alex.post('/api/uploads', [1, 2])[0] == 400
+    assert alex.post('/api/uploads', {'filename': 'a.txt', 'size': 'x'})[0] == 400
+    assert alex.post('/api/uploads', {'filename': 5, 'size': 10})[0] == 400
+    assert make_client().post('/api/uploads', {'filename': 'a.txt', 'size': 10})[0] == 401
+
+
+def test_range_request(make_client):
+    alex = make_client('alex')
+    attachment = upload(alex)
+    status, headers, body = alex.request('GET', attachment['url'], headers={'Range': 'bytes=100-199'})
+    assert status == 206
+    assert body == DATA[100:200]
+    assert headers['content-range'] == f'bytes 100-199/{len(DATA)}'
+
+
+def test_html_is_served_as_download(make_client):
+    alex = make_client('alex')
+    page = b'<script>alert(1)</script>'
+    attachment = upload(alex, page, filename='page.html', mime_type='text/html')
+    status, headers, body = alex.request('GET', attachment['url'])
+    assert status == 200
+    assert headers['content-disposition'].startswith('attachment')
+    assert headers['x-content-type-options'] == 'nosniff'
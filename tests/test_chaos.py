@@ -0,0 +1,19 @@
+"""Короткий прогон chaos.py: параллельные воркеры не получают ошибок занятой БД"""
+
+import pytest
+
+import chaos
+
+
+@pytest.mark.parametrize('shards', [0, 3], ids=['single', 'shards'])
+def test_no_locked_requests(tmp_path, shards):
+    args = chaos.parse_args([
+        '--processes', '2', '--threads', '3', '--duration', '3',
+        '--shards', str(shards), '--directory', str(tmp_path),
+    ])
+    results, elapsed, locker_held = chaos.run(args)
+
+    assert len(results) == 2
+    assert sum(count for result in results
+               for (_, kind), count in result['outcomes'].items() if kind == 'ok') > 0
+    assert chaos.count_locked(results) == 0
@@ -0,0 +1,179 @@
+"""RespBus против локального брокера (замена Redis) на Unix-сокете"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from notify_bus import RespBus
+
+BUS_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'notify_bus.py')
+
+
+class BrokerProcess:
+    """Брокер notify_bus.py (run_broker) в отдельном процессе"""
+
+    def __init__(self, path):
+        self.path = path
+        self.process = subprocess.Popen(
+            [sys.executable, BUS_SCRIPT, 'broker', '--unix', path], stdout=subprocess.DEVNULL
+        )
+        deadline = time.time() + 10
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def stop(self):
+        # Завершение процесса обрывает все соединения клиентов
+        self.process.kill()
+        self.process.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@pytest.fixture
+def sock_path():
+    # Короткий путь: длина адреса Unix-сокета ограничена
+    directory = tempfile.mkdtemp(prefix='bus-')
+    yield os.path.join(directory, 'bus.sock')
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def broker(sock_path):
+    broker = BrokerProcess(sock_path)
+    yield broker
+    broker.stop()
+
+
+def make_bus(path, **options):
+    options.setdefault('reconnect_delay', 0.1)
+    options.setdefault('timeout', 2.0)
+    return RespBus(path, family=socket.AF_UNIX, **options)
+
+
+@pytest.fixture
+def buses(broker):
+    made = []
+
+    def make(**options):
+        bus = make_bus(broker.path, **options)
+        made.append(bus)
+        return bus
+
+    yield make
+    for bus in made:
+        bus.close()
+
+
+def test_publish_reaches_confirmed_subscriber(buses):
+    subscriber, publisher = buses(), buses()
+    received = []
+    got = threading.Event()
+    unsubscribe = subscriber.subscribe('user:1', lambda event: (received.append(event), got.set()))
+    # subscribe() вернулся после подтверждения: публикация сразу же доходит
+    assert publisher.publish('user:1', {'message_id': 7}) == 1
+    assert got.wait(2)
+    assert received == [{'message_id': 7}]
+
+    unsubscribe()
+    deadline = time.time() + 2
+    while publisher.publish('user:1', {}) != 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert publisher.publish('user:1', {}) == 0
+
+
+def test_subscribe_times_out_without_confirmation(sock_path):
+    # Сервер принимает соединения, но ничего не отвечает
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.bind(sock_path)
+    silent.listen(8)
+    bus = make_bus(sock_path, timeout=0.5)
+    try:
+        started = time.perf_counter()
+        with pytest.raises(ConnectionError):
+            bus.subscribe('user:1', lambda event: None)
+        assert time.perf_counter() - started < 2
+        # Неподтвержденная подписка снята
+        assert not bus._subscribers
+    finally:
+        bus.close()
+        silent.close()
+
+
+def test_resubscribes_after_broker_restart(broker, buses):
+    subscriber, publisher = buses(), buses()
+    got = threading.Event()
+    subscriber.subscribe('user:2', lambda event: got.set())
+
+    broker.stop()
+    restarted = BrokerProcess(broker.path)
+    try:
+        # Подписчик переподключается сам и подписывается на канал заново
+        deadline = time.time() + 5
+        while not got.is_set() and time.time() < deadline:
+            try:
+                publisher.publish('user:2', {})
+            except (OSError, ConnectionError):
+                pass
+            got.wait(0.1)
+        assert got.is_set()
+    finally:
+        restarted.stop()
+
+
+def test_resubscribe_racing_last_unsubscribe(buses):
+    """Две вкладки одного пользователя: одна уходит, другая тут же подписывается"""
+    subscriber, publisher = buses(), buses()
+    unsubscribe_old = subscriber.subscribe('user:3', lambda event: None)
+
+    # Растягиваем снятие последней подписки, чтобы новая попала в этот промежуток
+    removing = threading.Event()
+    channel_removed = subscriber._channel_removed
+
+    def slow_channel_removed(channel):
+        removing.set()
+        time.sleep(0.3)
+        channel_removed(channel)
+
+    subscriber._channel_removed = slow_channel_removed
+    leaving = threading.Thread(target=unsubscribe_old)
+    leaving.start()
+    assert removing.wait(2)
+
+    got = threading.Event()
+    unsubscribe = subscriber.subscribe('user:3', lambda event: got.set())
+    leaving.join()
+    publisher.publish('user:3', {})
+    assert got.wait(2)
+    unsubscribe()
+
+
+def test_wait_wakes_through_broker(broker, tmp_path):
+    import app as messenger
+    from conftest import make_config
+
+    messenger.create_app({**make_config(tmp_path), 'NOTIFY_BUS': f'unix://{broker.path}'})
+    try:
+        alex, maria = messenger.app.test_client(), messenger.app.test_client()
+        alex.post('/api/login', json={'username': 'alex', 'password': 'password123'})
+        maria.post('/api/login', json={'username': 'maria', 'password': 'password123'})
+        cursor = maria.get('/api/wait').get_json()['cursor']
+
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(
+            maria.get(f'/api/wait?cursor={cursor}&timeout=5').get_json()))
+        waiter.start()
+        time.sleep(0.3)
+        started = time.perf_counter()
+        message_id = alex.post('/api/send_message', json={'receiver_id': 2, 'message_text': 'x'}).get_json()['message_id']
+        waiter.join(5)
+        assert [e['message_id'] for e in result[0]['events']] == [message_id]
+        assert time.perf_counter() - started < 2
+    finally:
+        messenger.bus.close()
@@ -0,0 +1,85 @@
+"""Профилировщик запросов: порог, форма параметров, план и недочитанные курсоры"""
+
+import gc
+import json
+import sqlite3
+
+import pytest
+
+import app as messenger
+from conftest import make_config
+from profiler import ProfiledConnection, QueryProfiler
+
+
+def connect(threshold_ms=0):
+    conn = sqlite3.connect(':memory:', factory=ProfiledConnection)
+    conn.profiler = QueryProfiler(threshold_ms)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, password TEXT)")
+    conn.executemany("INSERT INTO users (password) VALUES (?)", [('секрет',), ('пароль',), ('ключ',)])
+    conn.profiler.recent.clear()
+    return conn
+
+
+def test_threshold_filters_fast_queries():
+    conn = connect(threshold_ms=60000)
+    conn.execute("SELECT * FROM users").fetchall()
+    assert conn.profiler.snapshot() == []
+    conn.close()
+
+
+def test_records_rows_and_params_shape_without_values():
+    conn = connect()
+    rows = conn.execute("SELECT id FROM users WHERE password != ?", ('секрет',)).fetchall()
+    entry, = conn.profiler.snapshot()
+    assert entry['rows'] == len(rows) == 2
+    assert entry['params'] == ['str']
+    assert 'секрет' not in json.dumps(entry, ensure_ascii=False)
+    conn.close()
+
+
+def test_records_query_plan():
+    conn = connect()
+    conn.execute("SELECT password FROM users WHERE id = ?", (1,)).fetchone()
+    entry, = conn.profiler.snapshot()
+    assert any('USING INTEGER PRIMARY KEY' in step for step in entry['plan'])
+    conn.close()
+
+
+def test_unread_cursor_is_logged_when_collected():
+    conn = connect()
+    cursor = conn.execute("SELECT id FROM users")
+    cursor.fetchone()
+    assert conn.profiler.snapshot() == []
+    # Соединение курсор не держит: запись появляется при его сборке
+    del cursor
+    gc.collect()
+    entry, = conn.profiler.snapshot()
+    assert entry['rows'] == 1
+    conn.close()
+
+
+@pytest.fixture
+def app_config(tmp_path, monkeypatch):
+    messenger.create_app({**make_config(tmp_path), 'ADMIN_USERS': ['alex']})
+    monkeypatch.setattr(messenger, 'profiler', None)
+    yield
+    messenger.bus.close()
+
+
+def login(username):
+    client = messenger.app.test_client()
+    client.post('/api/login', json={'username': username, 'password': 'password123'})
+    return client
+
+
+def test_slow_queries_endpoint(app_config, monkeypatch):
+    alex = login('alex')
+    assert alex.get('/api/admin/slow_queries').status_code == 404
+    assert login('maria').get('/api/admin/slow_queries').status_code == 403
+    assert messenger.app.test_client().get('/api/admin/slow_queries').status_code == 401
+
+    monkeypatch.setattr(messenger, 'profiler', QueryProfiler(0))
+    alex.get('/api/users')
+    data = alex.get('/api/admin/slow_queries').get_json()
+    assert data['threshold_ms'] == 0
+    assert any('FROM users' in query['sql'] for query in data['queries'])
@@ -0,0 +1,105 @@
+"""Сводная статистика: подсчет, повторный проход, отметки шардов и перенос"""
+
+import sqlite3
+
+import pytest
+
+import app as messenger
+from conftest import make_config
+from sharding import _init_shard_schema, rebalance
+
+ALEX, MARIA, IVAN = 1, 2, 3
+
+
+@pytest.fixture
+def config(tmp_path):
+    yield {**make_config(tmp_path), 'ADMIN_USERS': ['alex']}
+    messenger.bus.close()
+
+
+def login(username):
+    client = messenger.app.test_client()
+    client.post('/api/login', json={'username': username, 'password': 'password123'})
+    return client
+
+
+def send_all(client, receivers):
+    for receiver in receivers:
+        data = client.post('/api/send_message', json={'receiver_id': receiver, 'message_text': 'x'}).get_json()
+        assert data['success'], data
+
+
+def stats(client):
+    response = client.get('/api/admin/stats')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def counts(data):
+    conversations = {tuple(u['id'] for u in c['users']): c['messages'] for c in data['top_conversations']}
+    return sum(d['messages'] for d in data['daily']), sum(h['messages'] for h in data['hourly']), conversations
+
+
+@pytest.mark.parametrize('shard_count', [0, 3], ids=['single', 'shards'])
+def test_rollups_count_messages(config, shard_count):
+    messenger.create_app({**config, 'SHARD_COUNT': shard_count})
+    alex, maria = login('alex'), login('maria')
+    send_all(alex, [MARIA, MARIA, IVAN])
+    send_all(maria, [ALEX])
+
+    messenger.run_rollups()
+    data = stats(alex)
+    assert counts(data) == (4, 4, {(ALEX, MARIA): 3, (ALEX, IVAN): 1})
+    assert data['daily'][-1]['active_users'] == 2
+
+    # Повторный проход без новых сообщений ничего не добавляет
+    messenger.run_rollups()
+    assert stats(alex) == data
+
+    send_all(maria, [IVAN])
+    messenger.run_rollups()
+    data = stats(alex)
+    assert counts(data) == (5, 5, {(ALEX, MARIA): 3, (ALEX, IVAN): 1, (MARIA, IVAN): 1})
+    assert data['daily'][-1]['active_users'] == 2
+
+
+def test_watermark_per_shard(config):
+    messenger.create_app({**config, 'SHARD_COUNT': 3})
+    send_all(login('alex'), [MARIA, IVAN, IVAN])
+    messenger.run_rollups()
+
+    expected = {}
+    for path in messenger.router.paths():
+        db = sqlite3.connect(path)
+        last_id = db.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+        db.close()
+        # Пустой шард отметки не получает
+        if last_id is not None:
+            expected[path] = last_id
+    assert len(expected) == 2
+    assert {s['store']: s['last_id'] for s in stats(login('alex'))['stores']} == expected
+
+
+def test_rebalance_does_not_count_twice(config):
+    messenger.create_app(config)
+    alex = login('alex')
+    send_all(alex, [MARIA, IVAN])
+    messenger.run_rollups()
+    # Это сообщение учтет уже сам перенос
+    send_all(alex, [MARIA])
+
+    rebalance(config['DATABASE'], config['SHARD_PATH'], 0, 3, _init_shard_schema)
+    messenger.create_app({**config, 'SHARD_COUNT': 3})
+    messenger.run_rollups()
+    assert counts(stats(alex))[0] == 3
+
+    send_all(alex, [IVAN])
+    messenger.run_rollups()
+    assert counts(stats(alex))[2] == {(ALEX, MARIA): 2, (ALEX, IVAN): 2}
+
+
+def test_stats_for_admins_only(config):
+    messenger.create_app(config)
+    assert messenger.app.test_client().get('/api/admin/stats').status_code == 401
+    assert login('maria').get('/api/admin/stats').status_code == 403
+    assert login('alex').get('/api/admin/stats?days=x').status_code == 400
@@ -0,0 +1,165 @@
+"""Шарды: параллельная запись, id сообщений и перенос переписок"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import app as messenger
+from conftest import make_config
+from dblocks import begin_write
+from sharding import MESSAGE_ID_EPOCH, ShardRouter, _init_shard_schema, next_message_id, rebalance
+
+
+@pytest.fixture
+def config(tmp_path):
+    yield make_config(tmp_path, shard_count=3)
+    messenger.bus.close()
+
+
+def login(username):
+    client = messenger.app.test_client()
+    client.post('/api/login', json={'username': username, 'password': 'password123'})
+    return client
+
+
+def test_writes_to_different_shards_do_not_wait(config):
+    messenger.create_app(config)
+    assert messenger.router.shard_for(1, 2) != messenger.router.shard_for(1, 3)
+    events, held, released = [], threading.Event(), threading.Event()
+
+    def write(other, hold):
+        with messenger.app.app_context():
+            db = messenger.get_messages_db(1, other, write=True)
+            cursor = db.cursor()
+            begin_write(cursor)
+            messenger.store_message(
+                cursor, 1, {'receiver_id': other, 'message_text': 'x', 'attachment_id': None, 'client_id': None},
+                messenger.router.shard_for(1, other)
+            )
+            if hold:
+                held.set()
+                released.wait(5)
+            db.commit()
+            db.close()
+            events.append(other)
+
+    first = threading.Thread(target=write, args=(2, True))
+    first.start()
+    assert held.wait(5)
+    # Пока первый шард держит блокировку записи, второй успевает закоммитить
+    second = threading.Thread(target=write, args=(3, False))
+    second.start()
+    second.join(5)
+    released.set()
+    first.join(5)
+    assert events == [3, 2]
+
+
+def test_message_ids_do_not_collide_across_shards():
+    ids = []
+    for shard in range(3):
+        db = sqlite3.connect(':memory:')
+        db.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY)")
+        # Больше 64 id за миллисекунду: счетчик переполняется
+        for _ in range(1000):
+            db.execute("INSERT INTO messages VALUES (?)", (next_message_id(db.cursor(), shard),))
+        shard_ids = [row[0] for row in db.execute("SELECT id FROM messages ORDER BY rowid")]
+        assert shard_ids == sorted(shard_ids)
+        assert all(message_id & 63 == shard and message_id < 2 ** 53 for message_id in shard_ids)
+        ids += shard_ids
+    assert len(set(ids)) == len(ids)
+
+
+def test_message_ids_fit_53_bits_for_decades():
+    db = sqlite3.connect(':memory:')
+    db.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY)")
+    # Через 60 лет от MESSAGE_ID_EPOCH id все еще точен в JavaScript
+    assert (60 * 365 * 86400 * 1000) << 12 | 63 < 2 ** 53
+    assert next_message_id(db.cursor(), 5) < (int(time.time() * 1000) - MESSAGE_ID_EPOCH + 1000) << 12
+
+    # Шард с id, выданными по времени от 1970 года, продолжает счет от них
+    legacy = (int(time.time() * 1000) << 12) | 5
+    db.execute("INSERT INTO messages VALUES (?)", (legacy,))
+    assert next_message_id(db.cursor(), 5) == legacy + 64
+
+
+def run_rebalance(config, from_count, to_count):
+    return rebalance(config['DATABASE'], config['SHARD_PATH'], from_count, to_count, _init_shard_schema)
+
+
+def snapshot(client, other):
+    data = client.get(f'/api/messages?user_id={other}&since_seq=0').get_json()
+    return [(m['id'], m['message_text'], m['seq'], m['deleted']) for m in data['messages']], data['seq']
+
+
+def test_rebalance_keeps_conversations(config):
+    messenger.create_app({**config, 'SHARD_COUNT': 0})
+    alex = login('alex')
+    for receiver, text in ((2, 'a'), (3, 'b'), (2, 'c')):
+        message_id = alex.post('/api/send_message', json={'receiver_id': receiver, 'message_text': text}).get_json()['message_id']
+    alex.post('/api/edit_message', json={'message_id': message_id, 'user_id': 2, 'message_text': 'd'})
+    before = {other: snapshot(alex, other) for other in (2, 3)}
+
+    assert run_rebalance(config, 0, 3) == 3
+    messenger.create_app(config)
+    assert {other: snapshot(alex, other) for other in (2, 3)} == before
+
+    # Новое сообщение после переноса идет дальше по id и seq
+    alex.post('/api/send_message', json={'receiver_id': 2, 'message_text': 'e'})
+    messages, seq = snapshot(alex, 2)
+    assert messages[-1][0] > before[2][0][-1][0] and seq == before[2][1] + 1
+
+
+def copy_pair_to_target(config, low, high, change_text=False):
+    """Состояние после сбоя: переписка уже скопирована в целевой шард, но не удалена из источника"""
+    source = ShardRouter(2, config['SHARD_PATH']).path(ShardRouter(2).shard_for(low, high))
+    target = ShardRouter(3, config['SHARD_PATH'])
+    for path in target.paths():
+        db = sqlite3.connect(path)
+        db.row_factory = sqlite3.Row
+        _init_shard_schema(db)
+        db.close()
+    db = sqlite3.connect(target.path(target.shard_for(low, high)))
+    db.execute("ATTACH DATABASE ? AS source", (source,))
+    db.execute("INSERT INTO messages SELECT * FROM source.messages WHERE receiver_id = ?", (high,))
+    if change_text:
+        db.execute("UPDATE messages SET message_text = 'другое'")
+    db.commit()
+    db.close()
+    return source
+
+
+def pair_rows(path, receiver_id):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ?", (receiver_id,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_rebalance_rerun_skips_copied_rows(config):
+    messenger.create_app({**config, 'SHARD_COUNT': 2})
+    alex = login('alex')
+    for receiver in (2, 3, 3):
+        alex.post('/api/send_message', json={'receiver_id': receiver, 'message_text': 'x'})
+    before = {other: snapshot(alex, other) for other in (2, 3)}
+    source = copy_pair_to_target(config, 1, 3)
+
+    run_rebalance(config, 2, 3)
+    assert pair_rows(source, 3) == 0
+    messenger.create_app(config)
+    assert {other: snapshot(alex, other) for other in (2, 3)} == before
+
+
+def test_rebalance_conflict_keeps_source(config):
+    messenger.create_app({**config, 'SHARD_COUNT': 2})
+    alex = login('alex')
+    for _ in range(2):
+        alex.post('/api/send_message', json={'receiver_id': 3, 'message_text': 'x'})
+    source = copy_pair_to_target(config, 1, 3, change_text=True)
+
+    with pytest.raises(RuntimeError):
+        run_rebalance(config, 2, 3)
+    assert pair_rows(source, 3) == 2
@@ -0,0 +1,52 @@
+"""Потоковая выдача переписки во Flask: /api/messages и /api/messages/export"""
+
+import json
+
+import pytest
+
+import app as messenger
+from conftest import make_config
+
+COUNT = messenger.STREAM_CHUNK_ROWS + 50
+
+
+@pytest.fixture
+def client(tmp_path):
+    messenger.create_app(make_config(tmp_path, shard_count=3))
+    client = messenger.app.test_client()
+    client.post('/api/login', json={'username': 'alex', 'password': 'password123'})
+    for start in range(0, COUNT, messenger.app.config['MAX_BATCH_SIZE']):
+        size = min(messenger.app.config['MAX_BATCH_SIZE'], COUNT - start)
+        response = client.post('/api/send_batch', json={'messages': [
+            {'receiver_id': 2, 'message_text': f'm{n}'} for n in range(start, start + size)
+        ]})
+        assert all(r['success'] for r in response.get_json()['results'])
+    yield client
+    messenger.bus.close()
+
+
+def test_messages_are_streamed_in_chunks(client):
+    response = client.get(f'/api/messages?user_id=2&limit={COUNT}')
+    assert response.is_streamed
+    chunks = list(response.response)
+    response.close()
+    # Больше одной пачки строк - больше одной части ответа
+    assert len(chunks) > 3
+    data = json.loads(b''.join(chunks))
+    assert [m['message_text'] for m in data['messages']] == [f'm{n}' for n in range(COUNT)]
+    assert data['has_more'] is False
+
+
+def test_page_has_more_and_continues(client):
+    data = client.get('/api/messages?user_id=2&limit=100').get_json()
+    assert len(data['messages']) == 100 and data['has_more'] is True
+    rest = client.get(f"/api/messages?user_id=2&after_id={data['messages'][-1]['id']}").get_json()
+    assert len(data['messages']) + len(rest['messages']) == COUNT
+
+
+def test_export_returns_whole_conversation(client):
+    response = client.get('/api/messages/export?user_id=2')
+    assert response.status_code == 200 and response.is_streamed
+    data = json.loads(response.get_data())
+    assert len(data['messages']) == COUNT
+    assert client.get('/api/messages/export').status_code == 400
@@ -0,0 +1,96 @@
+"""Очередь превью: постановка, кэш, переполнение и упавший пул процессов"""
+
+import hashlib
+import io
+import os
+import signal
+import time
+
+import pytest
+
+from storage import ContentStore
+from thumbnails import ThumbnailPipeline
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ContentStore(str(tmp_path))
+    store.ensure_dirs()
+    return store
+
+
+@pytest.fixture
+def pipeline(store):
+    pipeline = ThumbnailPipeline(store, workers=1)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def put_image(store, color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(buffer, 'PNG')
+    data = buffer.getvalue()
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = store.object_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return sha256
+
+
+def wait_for(pipeline, sha256, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pipeline.exists(sha256) and sha256 not in pipeline._pending:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_submit_builds_thumbnail(store, pipeline):
+    sha256 = put_image(store, 'red')
+    assert pipeline.submit(sha256) is True
+    assert wait_for(pipeline, sha256)
+    with Image.open(pipeline.thumbnail_path(sha256)) as thumbnail:
+        assert thumbnail.format == 'JPEG'
+        assert max(thumbnail.size) <= 320
+
+
+def test_cached_thumbnail_is_not_rebuilt(store, pipeline):
+    sha256 = put_image(store, 'green')
+    pipeline.submit(sha256)
+    assert wait_for(pipeline, sha256)
+    assert pipeline.submit(sha256) is False
+
+
+def test_full_queue_drops_job(store):
+    pipeline = ThumbnailPipeline(store, workers=1, queue_size=1)
+    try:
+        first, second = put_image(store, 'blue'), put_image(store, 'white')
+        assert pipeline.submit(first) is True
+        # Слот занят первым заданием: второе отбрасывается, а не ждет
+        assert pipeline.submit(second) is False
+        assert wait_for(pipeline, first)
+        assert pipeline.submit(second) is True
+        assert wait_for(pipeline, second)
+    finally:
+        pipeline.shutdown()
+
+
+def test_broken_pool_is_rebuilt(store, pipeline):
+    first = put_image(store, 'yellow')
+    pipeline.submit(first)
+    assert wait_for(pipeline, first)
+
+    for pid in list(pipeline._executor._processes):
+        os.kill(pid, signal.SIGKILL)
+    deadline = time.time() + 10
+    while not pipeline._executor._broken and time.time() < deadline:
+        time.sleep(0.05)
+    assert pipeline._executor._broken
+
+    second = put_image(store, 'black')
+    assert pipeline.submit(second) is True
+    assert wait_for(pipeline, second)
@@ -0,0 +1,133 @@
+"""
+Фоновая генерация превью для изображений-вложений.
+
+Превью строятся в пуле процессов вне обработки запроса и кэшируются на
+диске по sha256 исходного файла: <root>/thumbs/<sha[:2]>/<sha>.jpg.
+Файл превью записывается атомарно (os.replace), а на время генерации
+создается lock-файл, поэтому несколько воркеров gunicorn не делают одну
+и ту же работу дважды и никогда не отдают недописанный файл.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_SIZE = (320, 320)
+LOCK_TIMEOUT = 60
+
+
+def generate_thumbnail(src, dst, size=THUMBNAIL_SIZE):
+    """Построить превью src в dst (выполняется в дочернем процессе)"""
+    lock = dst + '.lock'
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Превью уже строит другой процесс; зависший lock считаем мертвым
+        if time.time() - os.path.getmtime(lock) < LOCK_TIMEOUT:
+            return False
+        os.remove(lock)
+        return generate_thumbnail(src, dst, size)
+    os.close(fd)
+
+    try:
+        if os.path.exists(dst):
+            return True
+        tmp = f'{dst}.{os.getpid()}.tmp'
+        with Image.open(src) as image:
+            image.thumbnail(size)
+            image.convert('RGB').save(tmp, 'JPEG', quality=80, optimize=True)
+        os.replace(tmp, dst)
+        return True
+    finally:
+        os.remove(lock)
+
+
+class ThumbnailPipeline:
+    """Ограниченная очередь заданий на превью поверх пула процессов"""
+
+    def __init__(self, store, workers=2, queue_size=64):
+        self.store = store
+        self.thumbs_dir = os.path.join(store.root, 'thumbs')
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pending = set()
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._executor_lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def thumbnail_path(self, sha256):
+        return os.path.join(self.thumbs_dir, sha256[:2], sha256 + '.jpg')
+
+    def exists(self, sha256):
+        return os.path.exists(self.thumbnail_path(sha256))
+
+    def _get_executor(self, broken=None):
+        # Пул создается лениво, заново после fork, чтобы каждый воркер имел свой,
+        # и заново после падения дочернего процесса (сломанный пул не принимает задания)
+        with self._executor_lock:
+            executor = self._executor
+            if (executor is None or self._executor_pid != os.getpid()
+                    or executor is broken or getattr(executor, '_broken', False)):
+                if executor is not None and self._executor_pid == os.getpid():
+                    executor.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def submit(self, sha256):
+        """Поставить превью в очередь; при переполнении или ошибке пула задание
+        отбрасывается и будет поставлено снова при следующем запросе сообщений.
+        Исключений не бросает: вызывается из обработки запросов"""
+        if not self.enabled or self.exists(sha256):
+            return False
+
+        with self._lock:
+            if sha256 in self._pending or sha256 in self._failed:
+                return False
+            if not self._slots.acquire(blocking=False):
+                return False
+            self._pending.add(sha256)
+
+        dst = self.thumbnail_path(sha256)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        args = (generate_thumbnail, os.path.abspath(self.store.object_path(sha256)), dst)
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(*args)
+            except BrokenProcessPool:
+                future = self._get_executor(broken=executor).submit(*args)
+        except Exception as e:
+            self._done(sha256)
+            print(f"⚠️ Не удалось поставить превью в очередь: {e}")
+            return False
+        future.add_done_callback(lambda f: self._done(sha256, f))
+        return True
+
+    def _done(self, sha256, future=None):
+        with self._lock:
+            self._pending.discard(sha256)
+            error = future.exception() if future is not None and not future.cancelled() else None
+            # Битое изображение не пытаемся обрабатывать на каждом опросе;
+            # упавший пул - не вина изображения, его попробуем снова
+            if error is not None and not isinstance(error, BrokenProcessPool):
+                self._failed.add(sha256)
+        self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._executor = None